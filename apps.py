@@ -1,5 +1,4 @@
 import git
-import json
 import time
 import logging
 import argparse
@@ -7,6 +6,8 @@ import requests
 import traceback
 from tqdm import tqdm
 from pathlib import Path
+from state import MyJson
+from pics import ProductInfoFetcher
 from openpyxl import Workbook
 from steam.client import SteamClient
 from multiprocessing.pool import ThreadPool
@@ -17,25 +18,6 @@ from openpyxl.utils.exceptions import IllegalCharacterError
 lock = Lock()
 
 
-class MyJson(dict):
-
-    def __init__(self, path):
-        super().__init__()
-        self.path = Path(path)
-        self.load()
-
-    def load(self):
-        if not self.path.exists():
-            self.dump()
-            return
-        with self.path.open() as f:
-            self.update(json.load(f))
-
-    def dump(self):
-        with self.path.open('w') as f:
-            json.dump(self, f)
-
-
 class XiaoHeiHe:
     def __init__(self):
         self.app_info = MyJson('apps.json')
@@ -137,14 +119,8 @@ def get_app_info(repo):
             app_id_list.append(int(app_id))
     logging.info('Waiting to get all app info!')
     app_info_dict = {}
-    count = 0
-    while app_id_list[count:count + 300]:
-        fresh_resp = steam.get_product_info(app_id_list[count:count + 300], timeout=60)
-        count += 300
-        if fresh_resp:
-            for app_id, info in fresh_resp['apps'].items():
-                app_info_dict[int(app_id)] = info
-            logging.info(f'Acquired {len(app_info_dict)} app info!')
+    for app_id, info in ProductInfoFetcher(steam).fetch(app_id_list):
+        app_info_dict[app_id] = info
     if app_info_dict:
         app.update(app_info_dict)
         app.dump()
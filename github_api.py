@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import logging
+import requests
+from pathlib import Path
+from requests.adapters import HTTPAdapter
+from multiprocessing.dummy import Lock
+
+
+class GitHub:
+    log = logging.getLogger('GitHub')
+    api_url = 'https://api.github.com'
+
+    def __init__(self, token=None, cache_path=None, min_remaining=50, write_interval=1, email_ttl=7 * 86400):
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=32))
+        self.session.headers.update({'Accept': 'application/vnd.github+json', 'X-GitHub-Api-Version': '2022-11-28'})
+        if token:
+            self.session.headers['Authorization'] = f'Bearer {token}'
+        self.cache_path = Path(cache_path) if cache_path else None
+        if self.cache_path:
+            self.cache_path.mkdir(parents=True, exist_ok=True)
+        self.min_remaining = min_remaining
+        self.write_interval = write_interval
+        self.email_ttl = email_ttl
+        self.remaining = None
+        self.reset = 0
+        self.last_write = 0
+        self.lock = Lock()
+        self.email_lock = Lock()
+        self.email_dict = self.load_json('emails.json') or {}
+
+    def load_json(self, name):
+        if self.cache_path and (path := self.cache_path / name).exists():
+            try:
+                with path.open(encoding='utf-8') as f:
+                    return json.load(f)
+            except ValueError:
+                path.unlink(missing_ok=True)
+
+    def dump_json(self, name, data):
+        if not self.cache_path:
+            return
+        path = self.cache_path / name
+        tmp_path = path.with_name(f'{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        with tmp_path.open('w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def wait(self, write=False):
+        with self.lock:
+            now = time.time()
+            delay = 0
+            if self.remaining is not None and self.remaining <= self.min_remaining and now < self.reset:
+                delay = self.reset - now
+                self.log.info(f'Rate limit remaining {self.remaining}, wait {int(delay)} second!')
+            if write:
+                self.last_write = max(now + delay, self.last_write + self.write_interval)
+                delay = self.last_write - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def update(self, r):
+        with self.lock:
+            if 'x-ratelimit-remaining' in r.headers:
+                self.remaining = int(r.headers['x-ratelimit-remaining'])
+                self.reset = int(r.headers.get('x-ratelimit-reset', 0))
+            if r.status_code in (403, 429):
+                if retry_after := r.headers.get('retry-after'):
+                    self.remaining = 0
+                    self.reset = max(self.reset, time.time() + int(retry_after))
+                elif self.remaining == 0:
+                    self.reset = max(self.reset, time.time() + 1)
+                elif 'rate limit' in r.text.lower():
+                    self.remaining = 0
+                    self.reset = max(self.reset, time.time() + 60)
+
+    def request(self, method, url, retry_num=3, **kwargs):
+        if not url.startswith('http'):
+            url = self.api_url + url
+        kwargs.setdefault('timeout', 30)
+        for _ in range(retry_num):
+            self.wait(write=method != 'GET')
+            r = self.session.request(method, url, **kwargs)
+            self.update(r)
+            if r.status_code not in (403, 429) or self.remaining != 0:
+                return r
+            self.log.warning(f'{method} {url}: {r.status_code}, rate limited!')
+        return r
+
+    def get(self, url, **kwargs):
+        if not url.startswith('http'):
+            url = self.api_url + url
+        key = f'{hashlib.sha1(url.encode()).hexdigest()}.json'
+        cache = self.load_json(key) if self.cache_path else None
+        headers = dict(kwargs.pop('headers', None) or {})
+        if cache:
+            if cache.get('etag'):
+                headers['If-None-Match'] = cache['etag']
+            if cache.get('last_modified'):
+                headers['If-Modified-Since'] = cache['last_modified']
+        r = self.request('GET', url, headers=headers, **kwargs)
+        if r.status_code == 304 and cache:
+            self.log.debug(f'Not modified: {url}')
+            return cache['data']
+        data = r.json()
+        if r.status_code == 200 and (r.headers.get('etag') or r.headers.get('last-modified')):
+            self.dump_json(key, {'etag': r.headers.get('etag'), 'last_modified': r.headers.get('last-modified'),
+                                 'data': data})
+        return data
+
+    def get_pages(self, url, per_page=100):
+        data_list = []
+        page = 1
+        while True:
+            data = self.get(f'{url}{"&" if "?" in url else "?"}per_page={per_page}&page={page}')
+            if not data or not isinstance(data, list):
+                break
+            data_list.extend(data)
+            if len(data) < per_page:
+                break
+            page += 1
+        return data_list
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request('PATCH', url, **kwargs)
+
+    def get_user_email(self, author_name):
+        with self.email_lock:
+            if isinstance(cache := self.email_dict.get(author_name), dict) and \
+                    time.time() - cache.get('time', 0) < self.email_ttl:
+                return cache['email']
+        events = self.get(f'/users/{author_name}/events/public')
+        if not isinstance(events, list):
+            self.log.warning(f'Failed to get events of {author_name}: {events}')
+            return
+        email_set = set()
+        for i in events:
+            if not (payload := i.get('payload')):
+                continue
+            if not (commits := payload.get('commits')):
+                continue
+            for commit in commits:
+                if not (author := commit.get('author')):
+                    continue
+                if not (name := author.get('name')):
+                    continue
+                if name != author_name:
+                    continue
+                if not (email := author.get('email')):
+                    continue
+                email_set.add(email)
+        email = None
+        if len(email_set) == 1:
+            email = email_set.pop()
+        elif len(email_set) > 1:
+            email = next((i for i in email_set if not i.endswith('@users.noreply.github.com')), None)
+            email = email or email_set.pop()
+        with self.email_lock:
+            self.email_dict[author_name] = {'email': email, 'time': int(time.time())}
+            self.dump_json('emails.json', self.email_dict)
+        return email
@@ -0,0 +1,73 @@
+import os
+import git
+import json
+import logging
+from pathlib import Path
+from multiprocessing.dummy import Lock
+
+
+class ManifestHistory:
+    log = logging.getLogger('ManifestHistory')
+
+    def __init__(self, repo: git.Repo, path=None, max_count=256):
+        self.repo = repo
+        self.path = Path(path or Path(repo.common_dir) / 'manifest_history')
+        self.max_count = max_count
+        self.index_dict = {}
+        self.lock = Lock()
+
+    def build(self, tip):
+        index = {}
+        author = None
+        result = self.repo.git.log('--first-parent', '-m', '--no-renames', '--name-only',
+                                   '--format=%x00%an%x00%ae', tip)
+        for line in result.split('\n'):
+            if line.startswith('\0'):
+                author = line[1:].split('\0', 1)
+            elif line.endswith('.manifest') and line not in index:
+                index[line] = author
+        self.log.debug(f'Indexed {len(index)} manifests from {tip}')
+        return index
+
+    def load(self, cache_path):
+        try:
+            with cache_path.open(encoding='utf-8') as f:
+                index = json.load(f)
+            os.utime(cache_path)
+        except (FileNotFoundError, ValueError):
+            return
+        return index
+
+    def get_index(self, tip):
+        cache_path = self.path / f'{tip}.json'
+        with self.lock:
+            if (index := self.index_dict.get(tip)) is not None:
+                return index
+            index = self.load(cache_path)
+        if index is None:
+            index = self.build(tip)
+            with self.lock:
+                self.dump(cache_path, index)
+        with self.lock:
+            self.index_dict[tip] = index
+        return index
+
+    def dump(self, cache_path, index):
+        self.path.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_name(f'{cache_path.stem}.{os.getpid()}.tmp')
+        with tmp_path.open('w', encoding='utf-8') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, cache_path)
+        stat_list = []
+        for path in self.path.glob('*.json'):
+            try:
+                stat_list.append((path.stat().st_mtime, path))
+            except FileNotFoundError:
+                continue
+        stat_list.sort()
+        for _, path in stat_list[:max(len(stat_list) - self.max_count, 0)]:
+            path.unlink(missing_ok=True)
+
+    def get_author(self, tip, manifest_name):
+        if author := self.get_index(tip).get(manifest_name):
+            return git.Actor(*author)
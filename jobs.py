@@ -0,0 +1,103 @@
+import gevent
+import logging
+from collections import deque
+from gevent.event import Event
+
+
+class ManifestJob:
+
+    def __init__(self, app_id, depot_id, manifest_gid):
+        self.app_id = app_id
+        self.depot_id = depot_id
+        self.manifest_gid = manifest_gid
+        self.candidates = {}
+        self.failed = set()
+        self.running = None
+        self.done = False
+        self.exhausted = False
+
+    @property
+    def key(self):
+        return self.depot_id, self.manifest_gid
+
+    def available(self, username):
+        return not self.done and username in self.candidates and username not in self.failed
+
+
+class ManifestQueue:
+    log = logging.getLogger('ManifestQueue')
+
+    def __init__(self):
+        self.job_dict = {}
+        self.user_queue = {}
+        self.user_keys = {}
+        self.event = Event()
+
+    def notify(self):
+        self.event.set()
+        self.event.clear()
+
+    def put(self, username, cdn, app_id, depot_id, manifest_gid):
+        key = (depot_id, manifest_gid)
+        created = key not in self.job_dict
+        if created:
+            self.job_dict[key] = ManifestJob(app_id, depot_id, manifest_gid)
+        job = self.job_dict[key]
+        if job.done or username in job.failed or username in job.candidates:
+            return created
+        reopened = job.exhausted
+        if reopened:
+            self.log.debug(f'Reopen {depot_id}_{manifest_gid} for: {username}')
+            job.exhausted = False
+        job.candidates[username] = cdn
+        self.user_queue.setdefault(username, deque()).append(key)
+        self.user_keys.setdefault(username, set()).add(key)
+        self.notify()
+        return created or reopened
+
+    def take(self, username):
+        queue = self.user_queue.get(username)
+        while queue:
+            job = self.job_dict[queue.popleft()]
+            if job.available(username) and not job.running:
+                job.running = username
+                return job
+
+    def finish(self, job, username, success):
+        job.running = None
+        if success:
+            job.done = True
+        else:
+            job.failed.add(username)
+            fallback_list = [i for i in job.candidates if i not in job.failed]
+            if fallback_list:
+                self.log.debug(f'Requeue {job.depot_id}_{job.manifest_gid} for: {",".join(fallback_list)}')
+                for i in fallback_list:
+                    self.user_queue[i].append(job.key)
+            else:
+                job.exhausted = True
+        self.notify()
+        return job.done or job.exhausted
+
+    def pending(self, username):
+        for key in self.user_keys.get(username, ()):
+            if self.job_dict[key].available(username):
+                return True
+        return False
+
+    def drain(self, username, worker):
+        while True:
+            if job := self.take(username):
+                worker(job)
+                continue
+            if not self.pending(username):
+                return
+            self.event.wait(1)
+
+    def count(self, username):
+        return sum(1 for key in self.user_keys.get(username, ()) if self.job_dict[key].available(username))
+
+    def join(self, username, worker, worker_num):
+        worker_num = max(min(worker_num, self.count(username)), 1)
+        job_list = [gevent.spawn(self.drain, username, worker) for _ in range(worker_num)]
+        gevent.joinall(job_list)
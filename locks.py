@@ -0,0 +1,76 @@
+import time
+import logging
+from gevent.lock import RLock
+
+
+class TimedLock:
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = RLock()
+        self.depth = 0
+        self.acquired_at = 0
+        self.count = 0
+        self.contended = 0
+        self.wait_time = 0
+        self.max_wait = 0
+        self.hold_time = 0
+        self.max_hold = 0
+
+    def acquire(self, blocking=True, timeout=None):
+        start = time.monotonic()
+        if not self.lock.acquire(blocking, timeout):
+            return False
+        self.depth += 1
+        if self.depth == 1:
+            self.acquired_at = time.monotonic()
+            wait = self.acquired_at - start
+            self.count += 1
+            if wait > 0.001:
+                self.contended += 1
+            self.wait_time += wait
+            self.max_wait = max(self.max_wait, wait)
+        return True
+
+    def release(self):
+        self.depth -= 1
+        if not self.depth:
+            hold = time.monotonic() - self.acquired_at
+            self.hold_time += hold
+            self.max_hold = max(self.max_hold, hold)
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class LockRegistry:
+    log = logging.getLogger('LockRegistry')
+
+    def __init__(self):
+        self.lock_dict = {}
+
+    def __getitem__(self, name):
+        if (lock := self.lock_dict.get(name)) is None:
+            lock = self.lock_dict[name] = TimedLock(name)
+        return lock
+
+    def report(self):
+        stat_dict = {}
+        for name, lock in self.lock_dict.items():
+            name = name.split(':', 1)[0]
+            stat = stat_dict.setdefault(name, [0, 0, 0, 0, 0, 0, 0])
+            stat[0] += 1
+            stat[1] += lock.count
+            stat[2] += lock.contended
+            stat[3] += lock.wait_time
+            stat[4] = max(stat[4], lock.max_wait)
+            stat[5] += lock.hold_time
+            stat[6] = max(stat[6], lock.max_hold)
+        for name, (num, count, contended, wait_time, max_wait, hold_time, max_hold) in stat_dict.items():
+            self.log.info(f'{name}{f" x{num}" if num > 1 else ""}: acquired {count}, contended {contended}, '
+                          f'wait {wait_time:.2f}s (max {max_wait:.2f}s), hold {hold_time:.2f}s (max {max_hold:.2f}s)')
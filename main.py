@@ -1,10 +1,9 @@
 import os
 import git
-import sys
-import json
 import time
 import base64
 import gevent
+import gevent.pool
 import logging
 import argparse
 import platform
@@ -13,15 +12,20 @@ import functools
 import traceback
 import subprocess
 from pathlib import Path
+from state import MyJson, UserInfo, StateDB, SqliteJson, SqliteUserInfo
+from tags import TagIndex
+from odb import AppBranchWriter
+from jobs import ManifestQueue
+from ratelimit import RateLimiter, TokenBucket
+from pics import ProductInfoFetcher, get_app_changes
+from refs import get_snapshot
+from locks import LockRegistry
 from steam.enums import EResult
 from push import push, push_data
-from multiprocessing.pool import ThreadPool
-from multiprocessing.dummy import Pool, Lock
+from gevent.lock import BoundedSemaphore
 from steam.guard import generate_twofactor_code
 from DepotManifestGen.main import MySteamClient, MyCDNClient, get_manifest, BillingType, Result
 
-lock = Lock()
-sys.setrecursionlimit(100000)
 parser = argparse.ArgumentParser()
 parser.add_argument('-c', '--credential-location', default=None)
 parser.add_argument('-l', '--level', default='INFO')
@@ -35,25 +39,16 @@ parser.add_argument('-P', '--no-push', action='store_true', default=False)
 parser.add_argument('-u', '--update', action='store_true', default=False)
 parser.add_argument('-a', '--app-id', dest='app_id_list', action='extend', nargs='*')
 parser.add_argument('-U', '--users', dest='user_list', action='extend', nargs='*')
-
-
-class MyJson(dict):
-
-    def __init__(self, path):
-        super().__init__()
-        self.path = Path(path)
-        self.load()
-
-    def load(self):
-        if not self.path.exists():
-            self.dump()
-            return
-        with self.path.open() as f:
-            self.update(json.load(f))
-
-    def dump(self):
-        with self.path.open('w') as f:
-            json.dump(self, f)
+parser.add_argument('-T', '--refs-ttl', type=int, default=None)
+parser.add_argument('-L', '--login-num', type=int, default=4)
+parser.add_argument('-I', '--info-num', type=int, default=8)
+parser.add_argument('-D', '--download-num', type=int, default=32)
+parser.add_argument('-R', '--rate-limit', dest='rate_limit_list', action='extend', nargs='*')
+parser.add_argument('-g', '--max-change-gap', type=int, default=50000)
+parser.add_argument('-j', '--journal', action='store_true', default=False)
+parser.add_argument('-d', '--db', default=None)
+parser.add_argument('-M', '--commit-mode', choices=['worktree', 'odb'], default='worktree')
+parser.add_argument('-W', '--commit-window', type=float, default=5)
 
 
 class LogExceptions:
@@ -77,18 +72,26 @@ class ManifestAutoUpdate:
     app_info_path = ROOT / Path('appinfo.json')
     user_info_path = ROOT / Path('userinfo.json')
     two_factor_path = ROOT / Path('2fa.json')
+    pics_info_path = ROOT / Path('pics.json')
     key_path = ROOT / 'KEY'
+    odb_root = ROOT / 'odb'
     git_crypt_path = ROOT / ('git-crypt' + ('.exe' if platform.system().lower() == 'windows' else ''))
     repo = git.Repo()
     app_lock = {}
     pool_num = 8
+    login_num = 4
+    info_num = 8
+    download_num = 32
     retry_num = 3
-    remote_head = {}
+    refs_ttl = None
     update_wait_time = 86400
-    tags = set()
+    max_change_gap = 50000
+    commit_window = 5
 
     def __init__(self, credential_location=None, level=None, pool_num=None, retry_num=None, update_wait_time=None,
-                 key=None, init_only=False, cli=False, app_id_list=None, user_list=None):
+                 key=None, init_only=False, cli=False, app_id_list=None, user_list=None, refs_ttl=None,
+                 login_num=None, info_num=None, download_num=None, rate_limit_list=None, max_change_gap=None,
+                 journal=False, db=None, commit_mode='worktree', commit_window=None):
         if level:
             level = logging.getLevelName(level.upper())
         else:
@@ -99,11 +102,30 @@ class ManifestAutoUpdate:
         self.init_only = init_only
         self.cli = cli
         self.pool_num = pool_num or self.pool_num
+        self.login_semaphore = BoundedSemaphore(login_num or self.login_num)
+        self.info_semaphore = BoundedSemaphore(info_num or self.info_num)
+        self.download_num = download_num or self.download_num
+        self.download_semaphore = BoundedSemaphore(self.download_num)
+        self.manifest_queue = ManifestQueue()
+        self.locks = LockRegistry()
+        self.state_lock = self.locks['state']
+        self.io_lock = self.locks['io']
+        self.git_lock = self.locks['git']
+        self.rate_limiter = RateLimiter(rate_limit_list)
         self.retry_num = retry_num or self.retry_num
         self.update_wait_time = update_wait_time or self.update_wait_time
+        self.refs_ttl = refs_ttl or self.refs_ttl
+        self.max_change_gap = self.max_change_gap if max_change_gap is None else max_change_gap
         self.credential_location = Path(credential_location or self.ROOT / 'client')
         self.log.debug(f'credential_location: {credential_location}')
         self.key = key
+        self.commit_mode = commit_mode
+        self.commit_window = self.commit_window if commit_window is None else commit_window
+        self.commit_queue = {}
+        self.commit_timer = {}
+        self.app_writer = AppBranchWriter(self.repo)
+        self.app_branch_set = set()
+        self.worktree_dict = None
         self.app_sha = None
         if not self.check_app_repo_local('app'):
             if self.check_app_repo_remote('app'):
@@ -157,20 +179,25 @@ class ManifestAutoUpdate:
         if not self.credential_location.exists():
             self.credential_location.mkdir(exist_ok=True)
         self.account_info = MyJson(self.users_path)
-        self.user_info = MyJson(self.user_info_path)
-        self.app_info = MyJson(self.app_info_path)
+        self.state_db = None
+        if db:
+            self.state_db = StateDB(db)
+            self.user_info = SqliteUserInfo(self.user_info_path, self.state_db, 'user')
+            self.app_info = SqliteJson(self.app_info_path, self.state_db, 'depot')
+        else:
+            self.user_info = UserInfo(self.user_info_path, journal=journal)
+            self.app_info = MyJson(self.app_info_path, journal=journal)
         self.two_factor = MyJson(self.two_factor_path)
+        self.pics_info = MyJson(self.pics_info_path)
+        self.tag_index = TagIndex(self.repo)
         self.log.info('Waiting to get remote tags!')
         self.get_remote_tags()
         self.update_user_list = [*user_list] if user_list else []
         self.update_app_id_list = []
         if app_id_list:
             self.update_app_id_list = list(set(int(i) for i in app_id_list if i.isdecimal()))
-            for user, info in self.user_info.items():
-                if info['enable'] and info['app']:
-                    for app_id in info['app']:
-                        if app_id in self.update_app_id_list:
-                            self.update_user_list.append(user)
+            for user_list in self.get_app_users(self.update_app_id_list).values():
+                self.update_user_list.extend(user_list)
         self.update_user_list = list(set(self.update_user_list))
 
     def download_git_crypt(self):
@@ -191,49 +218,93 @@ class ManifestAutoUpdate:
             traceback.print_exc()
             exit()
 
-    def get_manifest_callback(self, username, app_id, depot_id, manifest_gid, args):
-        result = args.value
-        if not result:
-            self.log.warning(f'User {username}: get_manifest return {result.code.__repr__()}')
-            return
-        app_path = self.ROOT / f'depots/{app_id}'
+    def get_manifest_callback(self, username, app_id, depot_id, manifest_gid, result):
         try:
-            delete_list = result.get('delete_list') or []
-            manifest_commit = result.get('manifest_commit')
-            if len(delete_list) > 1:
-                self.log.warning('Deleted multiple files?')
+            if not result:
+                self.log.warning(f'User {username}: get_manifest return {getattr(result, "code", None).__repr__()}')
+                return
             self.set_depot_info(depot_id, manifest_gid)
-            app_repo = git.Repo(app_path)
-            with lock:
-                if manifest_commit:
-                    app_repo.create_tag(f'{depot_id}_{manifest_gid}', manifest_commit)
-                else:
-                    if delete_list:
-                        app_repo.git.rm(delete_list)
-                    app_repo.git.add(f'{depot_id}_{manifest_gid}.manifest')
-                    app_repo.git.add('config.vdf')
-                    app_repo.index.commit(f'Update depot: {depot_id}_{manifest_gid}')
-                    app_repo.create_tag(f'{depot_id}_{manifest_gid}')
+            with self.state_lock:
+                self.commit_queue.setdefault(int(app_id), []).append((depot_id, manifest_gid, result))
         except KeyboardInterrupt:
             raise
         except:
             logging.error(traceback.format_exc())
         finally:
-            with lock:
+            with self.state_lock:
                 if int(app_id) in self.app_lock:
-                    self.app_lock[int(app_id)].remove(depot_id)
-                    if int(app_id) not in self.user_info[username]['app']:
-                        self.user_info[username]['app'].append(int(app_id))
+                    self.app_lock[int(app_id)].discard(depot_id)
+                    self.user_info.add_app(username, app_id)
                     if not self.app_lock[int(app_id)]:
                         self.log.debug(f'Unlock app: {app_id}')
                         self.app_lock.pop(int(app_id))
+                flush = int(app_id) not in self.app_lock or not self.commit_window
+                if not flush and int(app_id) not in self.commit_timer:
+                    self.commit_timer[int(app_id)] = gevent.spawn_later(self.commit_window, self.flush_commit, app_id)
+            if flush:
+                self.flush_commit(app_id)
+
+    def get_repo_lock(self, app_id):
+        return self.locks[f'repo:{app_id}']
+
+    def flush_commit(self, app_id):
+        with self.state_lock:
+            entry_list = self.commit_queue.pop(int(app_id), [])
+            timer = self.commit_timer.pop(int(app_id), None)
+            if timer and timer is not gevent.getcurrent():
+                timer.kill(block=False)
+        if not entry_list:
+            return
+        with self.get_repo_lock(app_id):
+            try:
+                self.commit_app(app_id, entry_list)
+            except KeyboardInterrupt:
+                raise
+            except:
+                logging.error(traceback.format_exc())
+
+    def commit_app(self, app_id, entry_list):
+        tag_list = []
+        name_list = []
+        delete_list = []
+        for depot_id, manifest_gid, result in entry_list:
+            if manifest_commit := result.get('manifest_commit'):
+                tag_list.append((f'{depot_id}_{manifest_gid}', manifest_commit))
+                continue
+            if len(result.get('delete_list') or []) > 1:
+                self.log.warning('Deleted multiple files?')
+            delete_list.extend(result.get('delete_list') or [])
+            name_list.append(f'{depot_id}_{manifest_gid}')
+        if name_list:
+            message = f'Update depot: {", ".join(name_list)}'
+            if self.commit_mode == 'odb':
+                app_path = self.odb_root / f'depots/{app_id}'
+                file_dict = {f'{name}.manifest': app_path / f'{name}.manifest' for name in name_list}
+                remove_list = []
+                for i in self.app_writer.list_files(str(app_id)):
+                    if i.endswith('.manifest') and i not in file_dict and any(
+                            i.startswith(f'{name.split("_")[0]}_') for name in name_list):
+                        remove_list.append(i)
+                file_dict['config.vdf'] = app_path / 'config.vdf'
+                commit = self.app_writer.commit(str(app_id), file_dict, message, remove_list)
+                for name in name_list:
+                    (app_path / f'{name}.manifest').unlink(missing_ok=True)
+            else:
+                app_repo = git.Repo(self.ROOT / f'depots/{app_id}')
+                if delete_list:
+                    app_repo.git.rm('--ignore-unmatch', delete_list)
+                app_repo.git.add([f'{name}.manifest' for name in name_list], 'config.vdf')
+                commit = app_repo.index.commit(message)
+            tag_list.extend((name, commit) for name in name_list)
+        for tag in self.app_writer.create_tags(tag_list):
+            self.tag_index.add(tag)
 
     def set_depot_info(self, depot_id, manifest_gid):
-        with lock:
+        with self.state_lock:
             self.app_info[depot_id] = manifest_gid
 
     def save_user_info(self):
-        with lock:
+        with self.io_lock:
             self.user_info.dump()
 
     def save(self):
@@ -241,31 +312,56 @@ class ManifestAutoUpdate:
         self.save_user_info()
 
     def save_depot_info(self):
-        with lock:
+        with self.io_lock:
             self.app_info.dump()
 
-    def get_app_worktree(self):
-        worktree_dict = {}
-        with lock:
+    def compact(self):
+        with self.io_lock:
+            self.app_info.compact()
+            self.user_info.compact()
+
+    def get_app_worktree(self, refresh=False):
+        with self.git_lock:
+            if self.worktree_dict is not None and not refresh:
+                return self.worktree_dict
             worktree_list = self.repo.git.worktree('list').split('\n')
-        for worktree in worktree_list:
-            path, head, name, *_ = worktree.split()
-            name = name[1:-1]
-            if not name.isdecimal():
-                continue
-            worktree_dict[name] = (path, head)
-        return worktree_dict
+            worktree_dict = {}
+            for worktree in worktree_list:
+                path, head, name, *_ = worktree.split()
+                name = name[1:-1]
+                if not name.isdecimal():
+                    continue
+                worktree_dict[name] = (path, head)
+            self.worktree_dict = worktree_dict
+            return worktree_dict
+
+    def add_app_worktree(self, app_id, app_path, commit):
+        with self.git_lock:
+            try:
+                self.repo.git.worktree('add', '-b', app_id, app_path, commit)
+            except git.exc.GitCommandError:
+                if str(app_id) not in self.get_app_worktree(refresh=True):
+                    raise
+                return
+            self.worktree_dict[str(app_id)] = (str(app_path), self.repo.heads[str(app_id)].commit.hexsha)
 
     def get_remote_head(self):
-        if self.remote_head:
-            return self.remote_head
-        head_dict = {}
-        for i in self.repo.git.ls_remote('--head', 'origin').split('\n'):
-            commit, head = i.split()
-            head = head.split('/')[2]
-            head_dict[head] = commit
-        self.remote_head = head_dict
-        return head_dict
+        return get_snapshot(self.repo, ttl=self.refs_ttl).heads
+
+    def get_app_users(self, app_id_list):
+        if self.state_db:
+            with self.io_lock:
+                self.user_info.dump()
+            return self.state_db.get_app_users(app_id_list)
+        return self.user_info.get_app_users(app_id_list)
+
+    def get_changed_depots(self, manifest_dict):
+        if self.state_db:
+            with self.io_lock:
+                self.app_info.dump()
+            return self.state_db.get_changed_depots(manifest_dict)
+        return {depot_id for depot_id, manifest in manifest_dict.items() if
+                depot_id in self.app_info and self.app_info[depot_id] != manifest}
 
     def check_app_repo_remote(self, repo):
         return str(repo) in self.get_remote_head()
@@ -277,72 +373,106 @@ class ManifestAutoUpdate:
         return False
 
     def get_remote_tags(self):
-        if not self.tags:
-            for i in filter(None, self.repo.git.ls_remote('--tags').split('\n')):
-                sha, tag = i.split()
-                tag = tag.split('/')[-1]
-                self.tags.add(tag)
-        return self.tags
+        if not self.tag_index.remote:
+            self.tag_index.update_remote(get_snapshot(self.repo, ttl=self.refs_ttl).tags)
+        return self.tag_index.remote
 
     def check_manifest_exist(self, depot_id, manifest_gid):
-        for tag in set([i.name for i in self.repo.tags] + [*self.tags]):
-            if f'{depot_id}_{manifest_gid}' == tag:
-                return True
-        return False
+        return f'{depot_id}_{manifest_gid}' in self.tag_index
 
-    def init_app_repo(self, app_id):
-        app_path = self.ROOT / f'depots/{app_id}'
-        if str(app_id) not in self.get_app_worktree():
-            if app_path.exists():
-                app_path.unlink(missing_ok=True)
-            if self.check_app_repo_remote(app_id):
-                with lock:
-                    if not self.check_app_repo_local(app_id):
+    def init_app_branch(self, app_id):
+        app_path = self.odb_root / f'depots/{app_id}'
+        with self.get_repo_lock(app_id):
+            if str(app_id) in self.app_branch_set:
+                return
+            if not self.check_app_repo_local(app_id):
+                remote = self.check_app_repo_remote(app_id)
+                with self.git_lock:
+                    if remote:
                         self.repo.git.fetch('origin', f'{app_id}:origin_{app_id}')
-                self.repo.git.worktree('add', '-b', app_id, app_path, f'origin_{app_id}')
+                        self.repo.git.branch(app_id, f'origin_{app_id}')
+                    else:
+                        self.repo.git.branch(app_id, 'app')
+            app_path.mkdir(parents=True, exist_ok=True)
+            for i in app_path.glob('*.manifest'):
+                i.unlink(missing_ok=True)
+            config_path = app_path / 'config.vdf'
+            if (config := self.app_writer.get_file(str(app_id), 'config.vdf')) is None:
+                config_path.unlink(missing_ok=True)
             else:
-                if self.check_app_repo_local(app_id):
-                    self.log.warning(f'Branch {app_id} does not exist locally and remotely!')
-                    self.repo.git.branch('-d', app_id)
-                self.repo.git.worktree('add', '-b', app_id, app_path, 'app')
+                config_path.write_bytes(config)
+            self.app_branch_set.add(str(app_id))
 
-    def retry(self, fun, *args, retry_num=-1, **kwargs):
+    def init_app_repo(self, app_id):
+        if self.commit_mode == 'odb':
+            return self.init_app_branch(app_id)
+        app_path = self.ROOT / f'depots/{app_id}'
+        with self.get_repo_lock(app_id):
+            worktree_dict = self.get_app_worktree()
+            if str(app_id) in worktree_dict and not Path(worktree_dict[str(app_id)][0]).exists():
+                self.log.debug(f'Worktree of {app_id} is missing, refreshing worktree list!')
+                with self.git_lock:
+                    self.repo.git.worktree('prune')
+                worktree_dict = self.get_app_worktree(refresh=True)
+            if str(app_id) not in worktree_dict:
+                if app_path.exists():
+                    app_path.unlink(missing_ok=True)
+                if self.check_app_repo_remote(app_id):
+                    with self.git_lock:
+                        if not self.check_app_repo_local(app_id):
+                            self.repo.git.fetch('origin', f'{app_id}:origin_{app_id}')
+                    self.add_app_worktree(app_id, app_path, f'origin_{app_id}')
+                else:
+                    if self.check_app_repo_local(app_id):
+                        self.log.warning(f'Branch {app_id} does not exist locally and remotely!')
+                        with self.git_lock:
+                            self.repo.git.branch('-d', app_id)
+                    self.add_app_worktree(app_id, app_path, 'app')
+
+    def retry(self, fun, *args, retry_num=-1, bucket=None, **kwargs):
+        attempt = 0
         while retry_num:
+            if bucket:
+                self.rate_limiter.acquire(bucket)
             try:
-                return fun(*args, **kwargs)
+                result = fun(*args, **kwargs)
             except gevent.timeout.Timeout as e:
                 retry_num -= 1
+                attempt += 1
                 self.log.warning(e)
+                gevent.sleep(TokenBucket.retry_delay(EResult.Timeout, attempt))
             except Exception as e:
                 self.log.error(e)
                 return
+            else:
+                if bucket:
+                    self.rate_limiter.success(bucket)
+                return result
 
     def login(self, steam, username, password):
         self.log.info(f'Logging in to account {username}!')
         shared_secret = self.two_factor.get(username)
         steam.username = username
+        self.rate_limiter.acquire('login')
         result = steam.relogin()
-        wait = 1
         if result != EResult.OK:
             if result != EResult.Fail:
                 self.log.warning(f'User {username}: Relogin failure reason: {result.__repr__()}')
-            if result == EResult.RateLimitExceeded:
-                with lock:
-                    time.sleep(wait)
+            self.rate_limiter.backoff('login', result)
+            self.rate_limiter.acquire('login')
             result = steam.login(username, password, steam.login_key, two_factor_code=generate_twofactor_code(
                 base64.b64decode(shared_secret)) if shared_secret else None)
         count = self.retry_num
         while result != EResult.OK and count:
             if self.cli:
-                with lock:
+                with self.locks['cli']:
                     self.log.warning(f'Using the command line to interactively log in to account {username}!')
                     result = steam.cli_login(username, password)
                 break
-            elif result == EResult.RateLimitExceeded:
-                if not count:
-                    break
-                with lock:
-                    time.sleep(wait)
+            elif result in TokenBucket.backoff_base or result in TokenBucket.retry_base:
+                if not self.rate_limiter.backoff('login', result):
+                    gevent.sleep(TokenBucket.retry_delay(result, self.retry_num - count + 1))
+                self.rate_limiter.acquire('login')
                 result = steam.login(username, password, steam.login_key, two_factor_code=generate_twofactor_code(
                     base64.b64decode(shared_secret)) if shared_secret else None)
             elif result in (EResult.AccountLogonDenied, EResult.AccountDisabled,
@@ -350,11 +480,12 @@ class ManifestAutoUpdate:
                 logging.warning(f'User {username} has been disabled!')
                 self.user_info[username]['enable'] = False
                 self.user_info[username]['status'] = result
+                self.user_info.touch(username)
                 break
-            wait += 1
             count -= 1
             self.log.error(f'User {username}: Login failure reason: {result.__repr__()}')
         if result == EResult.OK:
+            self.rate_limiter.success('login')
             self.log.info(f'User {username} login successfully!')
         else:
             self.log.error(f'User {username}: Login failure reason: {result.__repr__()}')
@@ -363,7 +494,13 @@ class ManifestAutoUpdate:
     def async_task(self, cdn, app_id, depot_id, manifest_gid):
         self.init_app_repo(app_id)
         manifest_path = self.ROOT / f'depots/{app_id}/{depot_id}_{manifest_gid}.manifest'
-        if manifest_path.exists():
+        if self.commit_mode == 'odb':
+            manifest_commit = self.app_writer.get_file_commit(str(app_id), manifest_path.name)
+            if manifest_commit:
+                self.log.debug(f'manifest_commit: {manifest_commit}')
+                return Result(result=True, app_id=app_id, depot_id=depot_id, manifest_gid=manifest_gid,
+                              manifest_commit=manifest_commit)
+        elif manifest_path.exists():
             self.log.debug(f'manifest_path exists: {manifest_path}')
             app_repo = git.Repo(self.ROOT / f'depots/{app_id}')
             try:
@@ -375,17 +512,21 @@ class ManifestAutoUpdate:
                 self.log.debug(f'manifest_commit: {manifest_commit}')
                 return Result(result=True, app_id=app_id, depot_id=depot_id, manifest_gid=manifest_gid,
                               manifest_commit=manifest_commit)
-        return get_manifest(cdn, app_id, depot_id, manifest_gid, True, self.ROOT, self.retry_num)
+        self.rate_limiter.acquire('cdn')
+        with self.download_semaphore:
+            return get_manifest(cdn, app_id, depot_id, manifest_gid, True,
+                                self.odb_root if self.commit_mode == 'odb' else self.ROOT, self.retry_num)
 
     def get_manifest(self, username, password, sentry_name=None):
-        with lock:
+        with self.state_lock:
             if username not in self.user_info:
-                self.user_info[username] = {}
-                self.user_info[username]['app'] = []
+                self.user_info[username] = {'app': set()}
             if 'update' not in self.user_info[username]:
                 self.user_info[username]['update'] = 0
+                self.user_info.touch(username)
             if 'enable' not in self.user_info[username]:
                 self.user_info[username]['enable'] = True
+                self.user_info.touch(username)
             if not self.user_info[username]['enable']:
                 logging.warning(f'User {username} is disabled!')
                 return
@@ -399,18 +540,22 @@ class ManifestAutoUpdate:
                 self.credential_location if self.credential_location else MySteamClient.credential_location) / sentry_name
         self.log.debug(f'User {username} sentry_path: {sentry_path}')
         steam = MySteamClient(str(self.credential_location), sentry_path)
-        result = self.login(steam, username, password)
+        with self.login_semaphore:
+            result = self.login(steam, username, password)
         if result != EResult.OK:
             return
         self.log.info(f'User {username}: Waiting to initialize the cdn client!')
-        cdn = self.retry(MyCDNClient, steam, retry_num=self.retry_num)
+        with self.info_semaphore:
+            cdn = self.retry(MyCDNClient, steam, retry_num=self.retry_num, bucket='cdn')
         if not cdn:
             logging.error(f'User {username}: Failed to initialize cdn!')
             return
         app_id_list = []
         if cdn.packages_info:
             self.log.info(f'User {username}: Waiting to get packages info!')
-            product_info = self.retry(steam.get_product_info, packages=cdn.packages_info, retry_num=self.retry_num)
+            with self.info_semaphore:
+                product_info = self.retry(steam.get_product_info, packages=cdn.packages_info,
+                                          retry_num=self.retry_num, bucket='info')
             if not product_info:
                 logging.error(f'User {username}: Failed to get packages info!')
                 return
@@ -422,133 +567,130 @@ class ManifestAutoUpdate:
         if not app_id_list:
             self.user_info[username]['enable'] = False
             self.user_info[username]['status'] = result
+            self.user_info.touch(username)
             logging.warning(f'User {username}: Does not have any app and has been disabled!')
             return
         self.log.debug(f'User {username}, paid app id list: ' + ','.join([str(i) for i in app_id_list]))
         self.log.info(f'User {username}: Waiting to get app info!')
-        fresh_resp = self.retry(steam.get_product_info, app_id_list, retry_num=self.retry_num)
+        with self.info_semaphore:
+            fresh_resp = self.retry(steam.get_product_info, app_id_list, retry_num=self.retry_num,
+                                    bucket='info')
         if not fresh_resp:
             logging.error(f'User {username}: Failed to get app info!')
             return
-        job_list = []
         flag = True
         for app_id in app_id_list:
             if self.update_app_id_list and int(app_id) not in self.update_app_id_list:
                 continue
-            with lock:
-                if int(app_id) in self.app_lock:
-                    continue
-                self.log.debug(f'Lock app: {app_id}')
-                self.app_lock[int(app_id)] = set()
             app = fresh_resp['apps'][app_id]
             if 'common' in app and app['common']['type'].lower() in ['game', 'dlc', 'application']:
                 if 'depots' not in fresh_resp['apps'][app_id]:
                     continue
                 for depot_id, depot in fresh_resp['apps'][app_id]['depots'].items():
-                    with lock:
-                        self.app_lock[int(app_id)].add(depot_id)
                     if 'manifests' in depot and 'public' in depot['manifests'] and int(
                             depot_id) in {*cdn.licensed_depot_ids, *cdn.licensed_app_ids}:
                         manifest_gid = depot['manifests']['public']
                         self.set_depot_info(depot_id, manifest_gid)
-                        with lock:
-                            if int(app_id) not in self.user_info[username]['app']:
-                                self.user_info[username]['app'].append(int(app_id))
-                            if self.check_manifest_exist(depot_id, manifest_gid):
-                                self.log.info(f'Already got the manifest: {depot_id}_{manifest_gid}')
-                                continue
+                        with self.state_lock:
+                            self.user_info.add_app(username, app_id)
+                        if self.check_manifest_exist(depot_id, manifest_gid):
+                            self.log.info(f'Already got the manifest: {depot_id}_{manifest_gid}')
+                            continue
                         flag = False
-                        job = gevent.Greenlet(LogExceptions(self.async_task), cdn, app_id, depot_id, manifest_gid)
-                        job.rawlink(
-                            functools.partial(self.get_manifest_callback, username, app_id, depot_id, manifest_gid))
-                        job_list.append(job)
-                        gevent.idle()
-                for job in job_list:
-                    job.start()
-            with lock:
-                if int(app_id) in self.app_lock and not self.app_lock[int(app_id)]:
-                    self.log.debug(f'Unlock app: {app_id}')
-                    self.app_lock.pop(int(app_id))
-        with lock:
+                        with self.state_lock:
+                            if self.manifest_queue.put(username, cdn, app_id, depot_id, manifest_gid):
+                                if int(app_id) not in self.app_lock:
+                                    self.log.debug(f'Lock app: {app_id}')
+                                    self.app_lock[int(app_id)] = set()
+                                self.app_lock[int(app_id)].add(depot_id)
+        with self.state_lock:
             if flag:
                 self.user_info[username]['update'] = int(time.time())
-        gevent.joinall(job_list)
+                self.user_info.touch(username)
+        self.manifest_queue.join(username, functools.partial(self.download_task, username), self.download_num)
+
+    def download_task(self, username, job):
+        cdn = job.candidates[username]
+        result = LogExceptions(self.async_task)(cdn, job.app_id, job.depot_id, job.manifest_gid)
+        if self.manifest_queue.finish(job, username, bool(result)):
+            self.get_manifest_callback(username, job.app_id, job.depot_id, job.manifest_gid, result)
+        else:
+            self.log.warning(f'User {username}: Failed to get manifest {job.depot_id}_{job.manifest_gid}, '
+                             f'handing it over to other users!')
 
     def run(self, update=False):
         if not self.account_info or self.init_only:
-            self.save()
-            self.account_info.dump()
+            self.compact()
+            self.account_info.dump(force=True)
+            self.tag_index.dump()
             return
         if update and not self.update_user_list:
             self.update()
             if not self.update_user_list:
                 return
-        with Pool(self.pool_num) as pool:
-            pool: ThreadPool
-            result_list = []
-            for username in self.account_info:
-                if self.update_user_list and username not in self.update_user_list:
-                    self.log.debug(f'User {username} has skipped the update!')
-                    continue
-                password, sentry_name = self.account_info[username]
-                result_list.append(
-                    pool.apply_async(LogExceptions(self.get_manifest), (username, password, sentry_name)))
-            try:
-                while pool._state == 'RUN':
-                    if all([result.ready() for result in result_list]):
-                        self.log.info('The program is finished and will exit in 10 seconds!')
-                        time.sleep(10)
-                        break
-                    self.save()
-                    time.sleep(1)
-            except KeyboardInterrupt:
-                with lock:
-                    pool.terminate()
-                os._exit(0)
-            finally:
-                self.save()
+        pool = gevent.pool.Pool(self.pool_num)
+        job_list = []
+        for username in self.account_info:
+            if self.update_user_list and username not in self.update_user_list:
+                self.log.debug(f'User {username} has skipped the update!')
+                continue
+            password, sentry_name = self.account_info[username]
+            job_list.append(pool.spawn(LogExceptions(self.get_manifest), username, password, sentry_name))
+        saver = gevent.spawn(self.save_loop)
+        try:
+            gevent.joinall(job_list)
+            self.log.info('The program is finished and will exit in 10 seconds!')
+            gevent.sleep(10)
+        except KeyboardInterrupt:
+            pool.kill()
+            os._exit(0)
+        finally:
+            saver.kill()
+            for app_id in list(self.commit_queue):
+                self.flush_commit(app_id)
+            self.compact()
+            self.tag_index.dump()
+            self.rate_limiter.report()
+            self.locks.report()
+
+    def save_loop(self):
+        while True:
+            gevent.sleep(1)
+            LogExceptions(self.save)()
 
     def update(self):
-        app_id_list = []
-        for user, info in self.user_info.items():
-            if info['enable']:
-                if info['app']:
-                    app_id_list.extend(info['app'])
-        app_id_list = list(set(app_id_list))
+        app_id_list = list(self.user_info.get_app_users(list(self.user_info.app_users)))
         logging.debug(app_id_list)
         steam = MySteamClient(str(self.credential_location))
         self.log.info('Logging in to anonymous!')
         steam.anonymous_login()
+        change_number = self.pics_info.get('change_number', 0)
+        current_change_number, change_app_set = get_app_changes(steam, change_number, self.max_change_gap)
+        if change_app_set is not None:
+            change_app_set.update(self.pics_info.get('pending', []))
+            app_id_list = [i for i in app_id_list if i in change_app_set]
+            self.log.info(f'Incremental update from change {change_number} to {current_change_number}: '
+                          f'{len(app_id_list)} app changed!')
         self.log.info('Waiting to get all app info!')
-        app_info_dict = {}
-        count = 0
-        while app_id_list[count:count + 300]:
-            fresh_resp = self.retry(steam.get_product_info, app_id_list[count:count + 300],
-                                    retry_num=self.retry_num, timeout=60)
-            count += 300
-            if fresh_resp:
-                for app_id, info in fresh_resp['apps'].items():
-                    if depots := info.get('depots'):
-                        app_info_dict[int(app_id)] = depots
-                self.log.info(f'Acquired {len(app_info_dict)} app info!')
+        fetcher = ProductInfoFetcher(steam, retry_num=self.retry_num, rate_limiter=self.rate_limiter)
         update_app_set = set()
-        for app_id, app_info in app_info_dict.items():
-            for depot_id, depot in app_info.items():
+        for app_id, info in fetcher.fetch(app_id_list):
+            manifest_dict = {}
+            for depot_id, depot in (info.get('depots') or {}).items():
                 if depot_id.isdecimal():
                     if manifests := depot.get('manifests'):
                         if manifest := manifests.get('public'):
-                            if depot_id in self.app_info and self.app_info[depot_id] != manifest:
-                                update_app_set.add(app_id)
-        update_app_user = {}
+                            manifest_dict[depot_id] = manifest
+            if self.get_changed_depots(manifest_dict):
+                update_app_set.add(app_id)
+        if not fetcher.failed:
+            self.pics_info['change_number'] = current_change_number
+        self.pics_info['pending'] = sorted(update_app_set)
+        self.pics_info.dump()
+        update_app_user = self.get_app_users(update_app_set)
         update_user_set = set()
-        for user, info in self.user_info.items():
-            if info['enable'] and info['app']:
-                for app_id in info['app']:
-                    if int(app_id) in update_app_set:
-                        if int(app_id) not in update_app_user:
-                            update_app_user[int(app_id)] = []
-                        update_app_user[int(app_id)].append(user)
-                        update_user_set.add(user)
+        for user_list in update_app_user.values():
+            update_user_set.update(user_list)
         self.log.debug(str(update_app_user))
         for user in self.account_info:
             if user not in self.user_info:
@@ -564,7 +706,11 @@ if __name__ == '__main__':
     args = parser.parse_args()
     ManifestAutoUpdate(args.credential_location, level=args.level, pool_num=args.pool_num, retry_num=args.retry_num,
                        update_wait_time=args.update_wait_time, key=args.key, init_only=args.init_only,
-                       cli=args.cli, app_id_list=args.app_id_list, user_list=args.user_list).run(update=args.update)
+                       cli=args.cli, app_id_list=args.app_id_list, user_list=args.user_list,
+                       refs_ttl=args.refs_ttl, login_num=args.login_num, info_num=args.info_num,
+                       download_num=args.download_num, rate_limit_list=args.rate_limit_list,
+                       max_change_gap=args.max_change_gap, journal=args.journal, db=args.db,
+                       commit_mode=args.commit_mode, commit_window=args.commit_window).run(update=args.update)
     if not args.no_push:
         if not args.init_only:
             push()
@@ -0,0 +1,71 @@
+import struct
+import shutil
+from pathlib import Path
+from binascii import crc32
+from zipfile import ZipFile, is_zipfile
+from steam.core.manifest import DepotManifest
+from steam.protobufs.content_manifest_pb2 import ContentManifestMetadata
+
+
+class ManifestHeader:
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.compressed = is_zipfile(self.path)
+        self.metadata = self.read_metadata()
+
+    @property
+    def depot_id(self):
+        return self.metadata.depot_id
+
+    @property
+    def gid(self):
+        return self.metadata.gid_manifest
+
+    @property
+    def creation_time(self):
+        return self.metadata.creation_time
+
+    @staticmethod
+    def read_section(f, magic):
+        section_magic, length = struct.unpack('<II', f.read(8))
+        if section_magic != magic:
+            raise ValueError(f'Expecting section {magic:#x}, got {section_magic:#x}')
+        return length
+
+    @staticmethod
+    def skip(f, length, chunk_size=1024 * 1024):
+        while length:
+            if not (data := f.read(min(length, chunk_size))):
+                raise EOFError
+            length -= len(data)
+
+    def read_metadata(self):
+        if self.compressed:
+            with ZipFile(self.path) as zf, zf.open(zf.filelist[0]) as f:
+                return self.parse_metadata(f)
+        with self.path.open('rb') as f:
+            return self.parse_metadata(f)
+
+    def parse_metadata(self, f):
+        self.skip(f, self.read_section(f, DepotManifest.PROTOBUF_PAYLOAD_MAGIC))
+        metadata = ContentManifestMetadata()
+        metadata.ParseFromString(f.read(self.read_section(f, DepotManifest.PROTOBUF_METADATA_MAGIC)))
+        return metadata
+
+    def load(self):
+        manifest = DepotManifest(self.path.read_bytes())
+        buffer = manifest.payload.SerializeToString()
+        crc_clear = crc32(struct.pack('<I', len(buffer)) + buffer)
+        if manifest.metadata.crc_clear != crc_clear:
+            manifest.metadata.crc_clear = crc_clear
+            return manifest, True
+        return manifest, False
+
+    def copy(self, path):
+        manifest, repaired = self.load()
+        if not repaired:
+            return shutil.copy(self.path, path)
+        with open(path, 'wb') as f:
+            f.write(manifest.serialize(compress=self.compressed))
+        return path
@@ -1,23 +1,26 @@
 import git
 import vdf
-import shutil
-import struct
 import logging
 import argparse
-import requests
 import traceback
-from main import MyJson
+from state import MyJson
+from refs import get_snapshot
+from history import ManifestHistory
+from github_api import GitHub
 from pathlib import Path
-from binascii import crc32
-from steam.core.manifest import DepotManifest
+from manifest import ManifestHeader
+from multiprocessing.pool import ThreadPool
+from multiprocessing.dummy import Pool, Lock
+
+lock = Lock()
 
 
 class Depot:
 
-    def __init__(self, path, app_info=None, author=None):
+    def __init__(self, path, app_info=None, author=None, history=None):
         self.path = Path(path)
         self.repo = git.Repo(self.path)
-        self.commit_list = self.get_all_commit()
+        self.history = history or ManifestHistory(self.repo)
         self.depot_key_dict = self.get_all_depot_key()
         self.depot_dict = self.get_all_manifest()
         self.app_info = app_info
@@ -38,33 +41,15 @@ class Depot:
             traceback.print_exc()
         return depot_key_dict
 
-    def get_all_commit(self, commit=None):
-        commit_list = []
-        if not commit:
-            commit = self.repo.head.commit
-        if commit:
-            commit_list.append(commit)
-        if commit.parents:
-            commit_list.extend(self.get_all_commit(commit.parents[0]))
-        return commit_list
-
     def get_manifest_author(self, manifest_name):
-        if self.commit_list:
-            for i in self.commit_list:
-                if manifest_name in i.stats.files:
-                    return i.author
+        return self.history.get_author(self.repo.head.commit.hexsha, manifest_name)
 
     def get_all_manifest(self):
         depot_dict = dict()
         for i in self.path.iterdir():
             if i.suffix == '.manifest':
                 try:
-                    with i.open('rb') as f:
-                        manifest = DepotManifest(f.read())
-                    buffer = manifest.payload.SerializeToString()
-                    crc_clear = crc32(struct.pack('<I', len(buffer)) + buffer)
-                    if manifest.metadata.crc_clear != crc_clear:
-                        manifest.metadata.crc_clear = crc_clear
+                    manifest = ManifestHeader(i)
                     depot_id = int(manifest.depot_id)
                     if depot_id in self.depot_key_dict:
                         depot_key = self.depot_key_dict[depot_id]
@@ -101,7 +86,7 @@ class Depot:
         elif self.author:
             author_name = self.author.name
             author_email = self.author.email
-        shutil.copy(manifest_path, self.path / f'{depot_id}_{manifest_gid}.manifest')
+        ManifestHeader(manifest_path).copy(self.path / f'{depot_id}_{manifest_gid}.manifest')
         self.merge_depot_key(depot_id, depot_key)
         self.repo.git.add(f'{depot_id}_{manifest_gid}.manifest')
         self.repo.git.add('config.vdf')
@@ -114,7 +99,8 @@ class Depot:
             self.repo.git.commit('-m', f'Update depot: {depot_id}_{manifest_gid}')
         self.repo.git.tag(f'{depot_id}_{manifest_gid}')
         if self.app_info:
-            self.app_info[str(depot_id)] = manifest_gid
+            with lock:
+                self.app_info[str(depot_id)] = manifest_gid
 
     def merge_depot(self, other):
         other: Depot
@@ -150,123 +136,151 @@ class Merge:
         self.repo = git.Repo()
         self.remote_head_dict = self.get_remote_head()
         self.repo_url = '/'.join(self.repo.git.remote('get-url', 'origin').split('/')[-2:])
-        self.headers = {'Accept': 'application/vnd.github+json',
-                        'Authorization': f'Bearer {token}', 'X-GitHub-Api-Version': '2022-11-28'}
+        self.github = GitHub(token, Path(self.repo.common_dir) / 'github_cache')
         self.pr_list = self.get_all_pr()
         self.local_heads = [i.name for i in self.repo.heads]
-        self.author_name = None
-        self.author_email = None
+        self.history = ManifestHistory(self.repo)
+        self.author_dict = {}
+        self.fetched_set = set()
 
-    def get_user_email(self):
-        if not self.author_name:
-            return
-        url = f'https://api.github.com/users/{self.author_name}/events/public'
-        r = requests.get(url, headers=self.headers)
-        email_set = set()
-        for i in r.json():
-            if not (payload := i.get('payload')):
-                continue
-            if not (commits := payload.get('commits')):
-                continue
-            for commit in commits:
-                if not (author := commit.get('author')):
-                    continue
-                if not (name := author.get('name')):
-                    continue
-                if name != self.author_name:
-                    continue
-                if not (email := author.get('email')):
-                    continue
-                email_set.add(email)
-        if len(email_set) == 1:
-            return email_set.pop()
-        elif len(email_set) > 1:
-            for i in email_set:
-                if not i.endswith('@users.noreply.github.com'):
-                    return i
-            return email_set.pop()
+    def get_user_email(self, author_name):
+        try:
+            return self.github.get_user_email(author_name)
+        except Exception as e:
+            self.log.warning(f'Failed to get email of {author_name}: {e}')
 
     def get_remote_head(self):
-        head_dict = {}
-        for i in self.repo.git.ls_remote('--head', 'origin').split('\n'):
-            commit, head = i.split()
-            head = head.split('/')[2]
-            head_dict[head] = commit
-        return head_dict
+        return get_snapshot(self.repo).heads
 
     def get_all_pr(self):
-        pr_list = []
-        page = 1
         self.log.info('Getting pr list!')
-        while True:
-            url = f'https://api.github.com/repos/{self.repo_url}/pulls?per_page=100&page={page}'
-            r = requests.get(url, headers=self.headers)
-            if not r.json():
-                break
-            pr_list.extend(r.json())
-            page += 1
-        return pr_list
+        return self.github.get_pages(f'/repos/{self.repo_url}/pulls')
 
     def get_head(self, name):
         for i in self.repo.heads:
             if i.name == name:
                 return i
 
-    def merge(self, num, app_id):
+    def resolve_authors(self, pr_list, pool_num=8):
+        user_dict = {i['user']['login']: i['user']['id'] for i in pr_list if i['user']['login']}
+        self.log.info(f'Resolving {len(user_dict)} pr authors!')
+        with Pool(pool_num) as pool:
+            pool: ThreadPool
+            email_list = pool.map(self.get_user_email, user_dict)
+        for (author_name, user_id), author_email in zip(user_dict.items(), email_list):
+            if not author_email:
+                author_email = f'{user_id}+{author_name}@users.noreply.github.com'
+            self.author_dict[author_name] = git.Actor(author_name, author_email)
+
+    def get_author(self, pr):
+        return self.author_dict.get(pr['user']['login']) or git.Actor(None, None)
+
+    def fetch_all(self, app_pr_dict, chunk_size=200):
+        refspec_list = []
+        for app_id, pr_list in app_pr_dict.items():
+            refspec_list.extend(self.get_pr_refspec(i['number']) for i in pr_list)
+            if app_id in self.remote_head_dict and f'origin_{app_id}' not in self.local_heads:
+                refspec_list.append(f'{app_id}:origin_{app_id}')
+        self.log.info(f'Fetching {len(refspec_list)} refs!')
+        for i in range(0, len(refspec_list), chunk_size):
+            chunk = refspec_list[i:i + chunk_size]
+            try:
+                self.repo.git.fetch('origin', *chunk)
+            except git.exc.GitCommandError as e:
+                self.log.warning(f'Batched fetch failed, refetching {len(chunk)} refs one by one: {e}')
+                for refspec in chunk:
+                    try:
+                        self.repo.git.fetch('origin', refspec)
+                    except git.exc.GitCommandError as e:
+                        self.log.error(f'Failed to fetch {refspec}: {e}')
+                        continue
+                    self.fetched_set.add(refspec)
+            else:
+                self.fetched_set.update(chunk)
+        with lock:
+            self.local_heads = [i.name for i in self.repo.heads]
+
+    @staticmethod
+    def get_pr_refspec(num):
+        return f'+pull/{num}/head:refs/remotes/origin/pr/{num}'
+
+    def fetch(self, refspec, ref):
+        if refspec not in self.fetched_set:
+            self.repo.git.fetch('origin', refspec)
+            self.fetched_set.add(refspec)
+        return ref
+
+    def merge(self, num, app_id, author):
         head_name = f'pr{app_id}'
-        origin_head_name = f'origin_{head_name}'
-        if origin_head_name not in self.local_heads:
-            self.repo.git.fetch('origin', f'pull/{num}/head:{origin_head_name}')
-        if head_name not in self.local_heads:
-            self.repo.git.worktree('add', '-b', head_name, self.ROOT / 'depots' / head_name, origin_head_name)
+        head_path = self.ROOT / 'depots' / head_name
+        pr_ref = self.fetch(self.get_pr_refspec(num), f'refs/remotes/origin/pr/{num}')
+        with lock:
+            if head_name not in self.local_heads:
+                self.repo.git.worktree('add', '-b', head_name, head_path, pr_ref)
+                self.local_heads.append(head_name)
+            else:
+                git.Repo(head_path).git.reset('--hard', pr_ref)
         pr_repo = self.get_head(head_name)
-        depot = Depot(self.ROOT / 'depots' / head_name, app_info=self.app_info)
+        depot = Depot(head_path, app_info=self.app_info, history=self.history)
         if app_id not in self.local_heads:
             if app_id in self.remote_head_dict:
                 sha = self.remote_head_dict[app_id]
                 if sha == pr_repo.commit.hexsha:
                     return
                 if f'origin_{app_id}' not in self.local_heads:
-                    self.repo.git.fetch('origin', f'{app_id}:origin_{app_id}')
-                self.repo.git.worktree('add', '-b', app_id, self.ROOT / 'depots' / app_id, f'origin_{app_id}')
+                    self.fetch(f'{app_id}:origin_{app_id}', f'refs/heads/origin_{app_id}')
+                start_point = f'origin_{app_id}'
             else:
-                self.repo.git.worktree('add', '-b', app_id, self.ROOT / 'depots' / app_id, 'app')
-        source_depot = Depot(self.ROOT / 'depots' / app_id, app_info=self.app_info,
-                             author=git.Actor(self.author_name, self.author_email))
+                start_point = 'app'
+            with lock:
+                self.repo.git.worktree('add', '-b', app_id, self.ROOT / 'depots' / app_id, start_point)
+                self.local_heads.append(app_id)
+        source_depot = Depot(self.ROOT / 'depots' / app_id, app_info=self.app_info, author=author,
+                             history=self.history)
         source_depot.merge_depot(depot)
 
     def close_pr(self, num):
-        url = f'https://api.github.com/repos/{self.repo_url}/pulls/{num}'
-        requests.patch(url, headers=self.headers, json={'state': 'closed'})
+        self.github.patch(f'/repos/{self.repo_url}/pulls/{num}', json={'state': 'closed'})
 
-    def merge_all(self):
-        for i in self.pr_list:
+    def merge_app(self, app_id, pr_list, close_pool):
+        for i in pr_list:
+            num = i['number']
             try:
-                num, app_id = i['number'], str(i['head']['ref'])
-                if not app_id.isdecimal():
-                    continue
-                self.author_name = i['user']['login']
-                user_id = i['user']['id']
-                if self.author_name:
-                    if not self.author_email:
-                        self.author_email = self.get_user_email()
-                    if not self.author_email:
-                        self.author_email = f'{user_id}+{self.author_name}@users.noreply.github.com'
-                self.log.info(
-                    f'Merging pr {num} to appid {app_id} from {git.Actor(self.author_name, self.author_email).__repr__()}!')
-                self.merge(num, app_id)
+                author = self.get_author(i)
+                self.log.info(f'Merging pr {num} to appid {app_id} from {author.__repr__()}!')
+                self.merge(num, app_id, author)
             except:
                 traceback.print_exc()
             else:
                 self.log.info(f'closing pr {num}!')
-                self.close_pr(num)
+                close_pool.apply_async(self.close_pr, (num,), error_callback=lambda e, num=num: self.log.error(
+                    f'Failed to close pr {num}: {e}'))
+
+    def merge_all(self, pool_num=8):
+        app_pr_dict = {}
+        for i in self.pr_list:
+            if (app_id := str(i['head']['ref'])).isdecimal():
+                app_pr_dict.setdefault(app_id, []).append(i)
+        if not app_pr_dict:
+            return
+        self.resolve_authors([i for pr_list in app_pr_dict.values() for i in pr_list], pool_num)
+        self.fetch_all(app_pr_dict)
+        with Pool(pool_num) as pool, Pool(4) as close_pool:
+            pool: ThreadPool
+            result_list = [pool.apply_async(self.merge_app, (app_id, pr_list, close_pool)) for app_id, pr_list in
+                           app_pr_dict.items()]
+            for result in result_list:
+                result.wait()
+            close_pool.close()
+            close_pool.join()
         self.app_info.dump()
 
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-t', '--token')
 parser.add_argument('-l', '--level', default='INFO')
+parser.add_argument('-p', '--pool-num', type=int, default=8)
 
 if __name__ == '__main__':
     args = parser.parse_args()
-    Merge(token=args.token, level=args.level).merge_all()
+    Merge(token=args.token, level=args.level).merge_all(pool_num=args.pool_num)
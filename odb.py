@@ -0,0 +1,65 @@
+import git
+import logging
+from io import BytesIO
+from pathlib import Path
+from gitdb import IStream
+from git.refs import Head
+
+
+class AppBranchWriter:
+    log = logging.getLogger('AppBranchWriter')
+
+    def __init__(self, repo: git.Repo):
+        self.repo = repo
+
+    def store_blob(self, data):
+        return self.repo.odb.store(IStream(b'blob', len(data), BytesIO(data))).binsha
+
+    def store_tree(self, entry_dict):
+        data = b''
+        for name, (mode, binsha) in sorted(entry_dict.items(),
+                                           key=lambda x: x[0].encode() + (b'/' if x[1][0] == 0o40000 else b'')):
+            data += f'{mode:o} {name}'.encode() + b'\0' + binsha
+        return git.Tree(self.repo, self.repo.odb.store(IStream(b'tree', len(data), BytesIO(data))).binsha)
+
+    def create_tags(self, tag_list):
+        created_list = []
+        for tag, commit in tag_list:
+            try:
+                git.Reference.create(self.repo, f'refs/tags/{tag}', commit)
+            except OSError as e:
+                self.log.error(e)
+                continue
+            created_list.append(tag)
+        return created_list
+
+    def get_head(self, branch):
+        return Head(self.repo, f'refs/heads/{branch}')
+
+    def list_files(self, branch):
+        return [i.name for i in self.get_head(branch).commit.tree]
+
+    def get_file(self, branch, name):
+        try:
+            return self.get_head(branch).commit.tree[name].data_stream.read()
+        except KeyError:
+            pass
+
+    def get_file_commit(self, branch, name):
+        if self.get_file(branch, name) is None:
+            return
+        return self.repo.git.rev_list('-1', branch, '--', name).strip()
+
+    def commit(self, branch, file_dict, message, remove_list=()):
+        head = self.get_head(branch)
+        parent = head.commit
+        entry_dict = {i.name: (i.mode, i.binsha) for i in parent.tree}
+        for name in remove_list:
+            entry_dict.pop(name, None)
+        for name, path in file_dict.items():
+            entry_dict[name] = (0o100644, self.store_blob(Path(path).read_bytes()))
+        tree = self.store_tree(entry_dict)
+        commit = git.Commit.create_from_tree(self.repo, tree, message, parent_commits=[parent])
+        head.set_commit(commit, logmsg=f'commit: {message}')
+        self.log.debug(f'{branch}: {parent.hexsha} -> {commit.hexsha}')
+        return commit
@@ -0,0 +1,94 @@
+import time
+import gevent
+import logging
+from collections import deque
+from gevent.queue import Queue
+
+
+class ProductInfoFetcher:
+    log = logging.getLogger('ProductInfoFetcher')
+
+    def __init__(self, steam, chunk_size=300, min_chunk_size=50, max_chunk_size=1000, in_flight=4,
+                 target_latency=10, timeout=60, retry_num=3, rate_limiter=None, bucket='info'):
+        self.steam = steam
+        self.chunk_size = chunk_size
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.in_flight = in_flight
+        self.target_latency = target_latency
+        self.timeout = timeout
+        self.retry_num = retry_num
+        self.rate_limiter = rate_limiter
+        self.bucket = bucket
+        self.failed = 0
+
+    def adapt(self, latency):
+        if latency is None or latency > self.target_latency:
+            self.chunk_size = max(self.min_chunk_size, self.chunk_size // 2)
+        elif latency < self.target_latency / 2:
+            self.chunk_size = min(self.max_chunk_size, self.chunk_size + self.min_chunk_size)
+        self.log.debug(f'latency: {latency}, chunk_size: {self.chunk_size}')
+
+    def task(self, chunk, result_queue):
+        if self.rate_limiter:
+            self.rate_limiter.acquire(self.bucket)
+        start = time.monotonic()
+        try:
+            fresh_resp = self.steam.get_product_info(chunk, timeout=self.timeout)
+        except gevent.timeout.Timeout as e:
+            self.log.warning(e)
+            result_queue.put((chunk, None, None))
+        except Exception as e:
+            self.log.error(e)
+            result_queue.put((chunk, None, None))
+        else:
+            result_queue.put((chunk, fresh_resp, time.monotonic() - start))
+
+    def fetch(self, app_id_list):
+        pending = deque(app_id_list)
+        retry_dict = {}
+        result_queue = Queue()
+        running = 0
+        count = 0
+        while pending or running:
+            while pending and running < self.in_flight:
+                chunk = [pending.popleft() for _ in range(min(self.chunk_size, len(pending)))]
+                gevent.spawn(self.task, chunk, result_queue)
+                running += 1
+            chunk, fresh_resp, latency = result_queue.get()
+            running -= 1
+            self.adapt(latency)
+            if not fresh_resp:
+                retry_list = []
+                for app_id in chunk:
+                    retry_dict[app_id] = retry_dict.get(app_id, 0) + 1
+                    if retry_dict[app_id] <= self.retry_num:
+                        retry_list.append(app_id)
+                if len(retry_list) < len(chunk):
+                    self.failed += len(chunk) - len(retry_list)
+                    self.log.error(f'Failed to get {len(chunk) - len(retry_list)} app info!')
+                pending.extendleft(reversed(retry_list))
+                continue
+            for app_id, info in fresh_resp['apps'].items():
+                count += 1
+                yield int(app_id), info
+            self.log.info(f'Acquired {count} app info!')
+
+
+def get_app_changes(steam, change_number, max_gap=50000):
+    log = logging.getLogger('ProductInfoFetcher')
+    try:
+        resp = steam.get_changes_since(change_number or 0)
+    except gevent.timeout.Timeout as e:
+        log.warning(e)
+        resp = None
+    if not resp:
+        log.warning('Failed to get changes, fall back to full update!')
+        return change_number, None
+    current_change_number = resp.current_change_number
+    if not change_number or resp.force_full_update or resp.force_full_app_update:
+        return current_change_number, None
+    if not max_gap or current_change_number - change_number > max_gap:
+        log.info(f'Change number gap {current_change_number - change_number} is too large, fall back to full update!')
+        return current_change_number, None
+    return current_change_number, {i.appid for i in resp.app_changes}
@@ -1,9 +1,10 @@
 import git
-import time
 import logging
 import argparse
-import requests
 from tqdm import tqdm
+from refs import get_snapshot
+from pathlib import Path
+from github_api import GitHub
 
 
 class Pr:
@@ -20,8 +21,7 @@ class Pr:
         self.repo = git.Repo(repo)
         self.source_repo = source_repo
         self.add_source_repo()
-        self.headers = {'Accept': 'application/vnd.github+json',
-                        'Authorization': f'Bearer {token}', 'X-GitHub-Api-Version': '2022-11-28'}
+        self.github = GitHub(token, Path(self.repo.common_dir) / 'github_cache')
         self.owner_name, self.repo_name = self.repo.remote().url.split('/')[-2:]
         self.source_owner_name, self.source_repo_name = self.repo.remote('source').url.split('/')[-2:]
         self.origin_app_list, self.origin_tag_list = self.get_refs_list()
@@ -33,16 +33,7 @@ class Pr:
     def get_all_pr(self):
         if self.pr_list:
             return self.pr_list
-        pr_list = []
-        page = 1
-        while True:
-            url = f'https://api.github.com/repos/{self.source_owner_name}/{self.source_repo_name}/pulls?per_page=100&page={page}'
-            r = requests.get(url, headers=self.headers)
-            if not r.json():
-                break
-            pr_list.extend(r.json())
-            page += 1
-        self.pr_list = pr_list
+        self.pr_list = self.github.get_pages(f'/repos/{self.source_owner_name}/{self.source_repo_name}/pulls')
         self.log.debug(str(self.pr_list))
         return self.pr_list
 
@@ -65,21 +56,12 @@ class Pr:
     def get_refs_list(self, repo=None):
         app_list = []
         tag_list = []
-        if repo:
-            result = self.repo.git.ls_remote(repo)
-        else:
-            result = self.repo.git.ls_remote()
-        for i in result.split('\n'):
-            if i:
-                sha, refs = i.split()
-                name = refs.split('/')[-1]
-                if refs.startswith('refs/heads/'):
-                    if name.isdecimal():
-                        app_id = int(name)
-                        app_list.append(app_id)
-                elif refs.startswith('refs/tags/'):
-                    if '_' in name:
-                        tag_list.append(name)
+        snapshot = get_snapshot(self.repo, repo or 'origin')
+        for name in snapshot.app_heads:
+            app_list.append(int(name))
+        for name in snapshot.tags:
+            if '_' in name:
+                tag_list.append(name)
         return app_list, tag_list
 
     def contains(self, tag):
@@ -116,25 +98,12 @@ class Pr:
                 app_id_list.append(app_id)
         self.log.debug(str(app_id_list))
         for app_id in app_id_list:
-            url = f'https://api.github.com/repos/{self.source_owner_name}/{self.source_repo_name}/pulls'
-            r = requests.post(url, headers=self.headers,
-                              json={'title': str(app_id), 'head': f'{self.owner_name}:{app_id}', 'base': 'main'})
+            r = self.github.post(f'/repos/{self.source_owner_name}/{self.source_repo_name}/pulls',
+                                 json={'title': str(app_id), 'head': f'{self.owner_name}:{app_id}', 'base': 'main'})
             if r.status_code == 201:
                 self.log.info(f'pr successfully: {app_id}')
-                time.sleep(15)
                 continue
             self.log.info(f'pr failed: {app_id}, result: {r.text}, headers: {r.headers}')
-            if r.status_code == 403 and 'x-ratelimit-reset' in r.headers:
-                t = int(r.headers['x-ratelimit-reset'])
-                now = int(time.time())
-                if now < t:
-                    count = t - now
-                    self.log.info(f'Wait {count} second!')
-                    while count:
-                        time.sleep(1)
-                        count -= 1
-                        self.log.debug(f'Wait {count} second!')
-            time.sleep(15)
 
 
 parser = argparse.ArgumentParser()
@@ -1,8 +1,10 @@
 import git
 import time
+import argparse
 import traceback
 import subprocess
 from pathlib import Path
+from refs import get_snapshot
 from git import GitCommandError
 from multiprocessing.pool import ThreadPool
 from multiprocessing.dummy import Pool, Lock
@@ -10,7 +12,52 @@ from multiprocessing.dummy import Pool, Lock
 lock = Lock()
 
 
-def push(repo=None):
+def push_chunk(index, refs_list, retry_num=3, wait=1):
+    count = retry_num
+    while True:
+        start = time.time()
+        try:
+            subprocess.check_call(['git', 'push', 'origin', *[f'{refs}:{refs}' for refs, sha in refs_list]])
+        except subprocess.CalledProcessError:
+            if not count:
+                with lock:
+                    print(f'Chunk {index}: push failed after {retry_num} retries!')
+                raise
+            count -= 1
+            with lock:
+                print(f'Chunk {index}: push failed, retry in {wait}s!')
+            time.sleep(wait)
+            wait *= 2
+            continue
+        t = max(time.time() - start, 0.001)
+        with lock:
+            print(f'Chunk {index}: pushed {len(refs_list)} refs in {t:.2f}s ({len(refs_list) / t:.1f} refs/s)')
+        return refs_list
+
+
+def get_push_plan(repo, snapshot, app_sha=None):
+    remote_head_dict = snapshot.app_heads
+    remote_tag_set = set(snapshot.tags)
+    branch_list = []
+    tag_list = []
+    for i in repo.git.for_each_ref('--format=%(objectname) %(*objectname) %(refname)', 'refs/heads',
+                                   'refs/tags').split('\n'):
+        if not i:
+            continue
+        sha, peeled_sha, refs = i.split(' ')
+        if refs.startswith('refs/heads/'):
+            name = refs[len('refs/heads/'):]
+            if not name.isdecimal() or remote_head_dict.get(name) == sha or sha == app_sha:
+                continue
+            branch_list.append((refs, sha))
+        elif refs.startswith('refs/tags/'):
+            if refs[len('refs/tags/'):] in remote_tag_set:
+                continue
+            tag_list.append((refs, peeled_sha or sha))
+    return branch_list, tag_list
+
+
+def push(repo=None, chunk_size=200, retry_num=3, pool_num=8, dry_run=False):
     if not repo:
         repo = git.Repo()
     app_sha = None
@@ -18,44 +65,23 @@ def push(repo=None):
         app_sha = repo.git.rev_parse('app').strip()
     except GitCommandError:
         pass
-    remote_head_list = []
-    remote_tag_list = []
-    for i in repo.git.ls_remote('origin').split('\n'):
-        sha, refs = i.split()
-        if refs.startswith('refs/heads/'):
-            head = refs.split('/')[2]
-            if head.isdecimal():
-                remote_head_list.append((sha, head))
-        elif refs.startswith('refs/tags/'):
-            tag = refs.split('/')[2]
-            remote_tag_list.append((sha, tag))
-    total_branch = 0
-    total_tag = 0
-    with Pool(8) as pool:
+    snapshot = get_snapshot(repo)
+    start = time.time()
+    branch_list, tag_list = get_push_plan(repo, snapshot, app_sha)
+    t = time.time() - start
+    for refs, sha in branch_list + tag_list:
+        print(refs.split('/', 2)[-1], sha)
+    if dry_run:
+        print(f'Planned {len(branch_list)} branch and {len(tag_list)} tag against {len(snapshot.heads)} remote heads '
+              f'and {len(snapshot.tags)} remote tags in {t:.3f}s!')
+        return True
+    refs_list = branch_list + tag_list
+    chunk_list = [refs_list[i:i + chunk_size] for i in range(0, len(refs_list), chunk_size)]
+    pushed_list = []
+    with Pool(pool_num) as pool:
         pool: ThreadPool
-        result_list = []
-        for local_head in repo.heads:
-            if local_head.name.isdecimal():
-                for remote_sha, remote_head in remote_head_list:
-                    if local_head.name == remote_head and local_head.commit.hexsha == remote_sha:
-                        break
-                else:
-                    if local_head.commit.hexsha == app_sha:
-                        continue
-                    total_branch += 1
-                    with lock:
-                        print(local_head.name, local_head.commit.hexsha)
-                    result_list.append(
-                        pool.map_async(subprocess.check_call, (['git', 'push', 'origin', local_head.name],)))
-        for local_tag in repo.tags:
-            for remote_sha, remote_tag in remote_tag_list:
-                if remote_tag == local_tag.name:
-                    break
-            else:
-                total_tag += 1
-                with lock:
-                    print(local_tag.name, local_tag.commit.hexsha)
-                result_list.append(pool.map_async(subprocess.check_call, (['git', 'push', 'origin', local_tag.name],)))
+        result_list = [pool.apply_async(push_chunk, (index, chunk, retry_num)) for index, chunk in
+                       enumerate(chunk_list)]
         try:
             while pool._state == 'RUN':
                 if all([result.ready() for result in result_list]):
@@ -66,10 +92,20 @@ def push(repo=None):
         finally:
             with lock:
                 pool.terminate()
-    print(f'Pushed {total_branch} branch!')
-    print(f'Pushed {total_tag} tag!')
-    if not all([result.successful() for result in result_list]):
-        return push(repo=repo)
+        for result in result_list:
+            if result.ready() and result.successful():
+                pushed_list.extend(result.get())
+    for refs, sha in pushed_list:
+        if refs.startswith('refs/heads/'):
+            snapshot.heads[refs[len('refs/heads/'):]] = sha
+        else:
+            snapshot.tags[refs[len('refs/tags/'):]] = sha
+    if pushed_list:
+        snapshot.dump()
+    pushed_set = set(pushed_list)
+    print(f'Pushed {len(pushed_set.intersection(branch_list))}/{len(branch_list)} branch!')
+    print(f'Pushed {len(pushed_set.intersection(tag_list))}/{len(tag_list)} tag!')
+    return len(pushed_list) == len(refs_list)
 
 
 def push_data(repo=None):
@@ -81,7 +117,7 @@ def push_data(repo=None):
     except git.exc.GitCommandError:
         pass
     try:
-        file_list = ['appinfo.json', 'userinfo.json', 'users.json', '2fa.json', 'apps.xlsx']
+        file_list = ['appinfo.json', 'userinfo.json', 'users.json', '2fa.json', 'pics.json', 'apps.xlsx']
         for i in file_list:
             path = Path('data') / i
             if path.is_file():
@@ -95,6 +131,14 @@ def push_data(repo=None):
         traceback.print_exc()
 
 
+parser = argparse.ArgumentParser()
+parser.add_argument('-b', '--chunk-size', type=int, default=200)
+parser.add_argument('-r', '--retry-num', type=int, default=3)
+parser.add_argument('-p', '--pool-num', type=int, default=8)
+parser.add_argument('-n', '--dry-run', action='store_true', default=False)
+
 if __name__ == '__main__':
-    push()
-    push_data()
+    args = parser.parse_args()
+    push(chunk_size=args.chunk_size, retry_num=args.retry_num, pool_num=args.pool_num, dry_run=args.dry_run)
+    if not args.dry_run:
+        push_data()
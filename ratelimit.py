@@ -0,0 +1,102 @@
+import time
+import gevent
+import random
+import logging
+from steam.enums import EResult
+
+
+class TokenBucket:
+    log = logging.getLogger('TokenBucket')
+    backoff_base = {EResult.RateLimitExceeded: 10, EResult.AccountLoginDeniedThrottle: 30}
+    retry_base = {EResult.Timeout: 1, EResult.ServiceUnavailable: 1, EResult.TryAnotherCM: 1, EResult.Busy: 1}
+    backoff_max = 600
+
+    def __init__(self, name, rate, capacity):
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.blocked_until = 0
+        self.failures = 0
+        self.acquired = 0
+        self.waited = 0
+        self.wait_time = 0
+        self.backoffs = 0
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        return now
+
+    def acquire(self, n=1):
+        start = time.monotonic()
+        slept = False
+        while True:
+            now = self.refill()
+            if now < self.blocked_until:
+                wait = self.blocked_until - now
+            elif self.tokens >= n:
+                self.tokens -= n
+                break
+            else:
+                wait = (n - self.tokens) / self.rate
+            gevent.sleep(wait)
+            slept = True
+        self.acquired += 1
+        if slept:
+            self.waited += 1
+            self.wait_time += time.monotonic() - start
+
+    def backoff(self, result):
+        if not (base := self.backoff_base.get(result)):
+            return 0
+        self.failures += 1
+        self.backoffs += 1
+        delay = min(base * 2 ** (self.failures - 1), self.backoff_max) * random.uniform(0.5, 1.5)
+        self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+        self.log.warning(f'{self.name}: {result.__repr__()}, backing off {delay:.1f}s!')
+        return delay
+
+    @classmethod
+    def retry_delay(cls, result, attempt):
+        if not (base := cls.retry_base.get(result)):
+            return 0
+        return min(base * 2 ** (attempt - 1), cls.backoff_max) * random.uniform(0.5, 1.5)
+
+    def success(self):
+        self.failures = 0
+
+    def report(self):
+        return (f'{self.name}: acquired {self.acquired}, waited {self.waited} times for {self.wait_time:.1f}s, '
+                f'backed off {self.backoffs} times')
+
+
+class RateLimiter:
+    log = logging.getLogger('RateLimiter')
+    default = {'login': (0.5, 3), 'info': (5, 10), 'cdn': (20, 50)}
+
+    def __init__(self, config_list=None):
+        config = dict(self.default)
+        for i in config_list or []:
+            name, value = i.split('=', 1)
+            rate, _, capacity = value.partition(':')
+            config[name] = (float(rate), float(capacity or rate))
+        self.bucket_dict = {name: TokenBucket(name, rate, capacity) for name, (rate, capacity) in config.items()}
+
+    def __getitem__(self, name):
+        return self.bucket_dict[name]
+
+    def acquire(self, name, n=1):
+        self.bucket_dict[name].acquire(n)
+
+    def backoff(self, name, result):
+        return self.bucket_dict[name].backoff(result)
+
+    def success(self, name):
+        self.bucket_dict[name].success()
+
+    def report(self):
+        for bucket in self.bucket_dict.values():
+            self.log.info(bucket.report())
@@ -0,0 +1,89 @@
+import os
+import re
+import git
+import json
+import time
+import logging
+from pathlib import Path
+from multiprocessing.dummy import Lock
+
+lock = Lock()
+snapshot_dict = {}
+
+
+class RefSnapshot:
+    log = logging.getLogger('RefSnapshot')
+
+    def __init__(self, repo: git.Repo, remote='origin', ttl=None):
+        self.repo = repo
+        self.remote = remote
+        self.ttl = ttl
+        self.path = Path(repo.common_dir) / 'refs_cache' / (re.sub(r'[^\w.-]', '_', remote) + '.json')
+        self.heads = {}
+        self.tags = {}
+        self.timestamp = 0
+        self.lock = Lock()
+        if not self.load():
+            self.fetch()
+
+    @property
+    def app_heads(self):
+        return {name: sha for name, sha in self.heads.items() if name.isdecimal()}
+
+    def load(self):
+        if not self.ttl or not self.path.exists():
+            return False
+        try:
+            with self.path.open(encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if time.time() - data.get('timestamp', 0) > self.ttl:
+            return False
+        self.heads = data['heads']
+        self.tags = data['tags']
+        self.timestamp = data['timestamp']
+        self.log.debug(f'Loaded {len(self.heads)} heads and {len(self.tags)} tags of {self.remote} from cache')
+        return True
+
+    def fetch(self):
+        heads = {}
+        tags = {}
+        for i in self.repo.git.ls_remote(self.remote).split('\n'):
+            if not i:
+                continue
+            sha, refs = i.split()
+            if refs.startswith('refs/heads/'):
+                heads[refs[len('refs/heads/'):]] = sha
+            elif refs.startswith('refs/tags/'):
+                tag = refs[len('refs/tags/'):]
+                if tag.endswith('^{}'):
+                    tag = tag[:-3]
+                tags[tag] = sha
+        with self.lock:
+            self.heads = heads
+            self.tags = tags
+            self.timestamp = time.time()
+        self.log.debug(f'Fetched {len(heads)} heads and {len(tags)} tags of {self.remote}')
+        self.dump()
+
+    def dump(self):
+        with self.lock:
+            data = {'timestamp': self.timestamp, 'heads': self.heads, 'tags': self.tags}
+            self.path.parent.mkdir(exist_ok=True)
+            tmp_path = self.path.with_name(self.path.name + '.tmp')
+            with tmp_path.open('w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+
+
+def get_snapshot(repo=None, remote='origin', ttl=None, refresh=False):
+    if not repo:
+        repo = git.Repo()
+    key = (str(Path(repo.common_dir).absolute()), remote)
+    with lock:
+        if key not in snapshot_dict:
+            snapshot_dict[key] = RefSnapshot(repo, remote, ttl)
+        elif refresh:
+            snapshot_dict[key].fetch()
+        return snapshot_dict[key]
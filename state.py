@@ -0,0 +1,314 @@
+import os
+import json
+import hashlib
+import sqlite3
+import logging
+from pathlib import Path
+
+deleted = object()
+
+
+def encode(o):
+    if isinstance(o, set):
+        return sorted(o)
+    raise TypeError(f'Object of type {o.__class__.__name__} is not JSON serializable')
+
+
+class MyJson(dict):
+
+    def __init__(self, path, journal=False, compact_size=1000):
+        super().__init__()
+        self.path = Path(path)
+        self.journal = journal
+        self.journal_path = self.path.with_name(self.path.name + '.journal')
+        self.journal_size = 0
+        self.compact_size = compact_size
+        self.dirty = set()
+        self.load()
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.dirty.add(key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.dirty.add(key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *args):
+        if key in self:
+            self.dirty.add(key)
+        return super().pop(key, *args)
+
+    def clear(self):
+        self.dirty.update(self)
+        super().clear()
+
+    def touch(self, key):
+        self.dirty.add(key)
+
+    def load(self):
+        if not self.path.exists():
+            self.dump(force=True)
+        else:
+            with self.path.open() as f:
+                super().update(json.load(f))
+        if self.journal_path.exists():
+            with self.journal_path.open() as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    if record.get('d'):
+                        super().pop(record['k'], None)
+                    else:
+                        super().__setitem__(record['k'], record['v'])
+                    self.journal_size += 1
+        self.dirty.clear()
+
+    def write(self):
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with tmp_path.open('w') as f:
+            json.dump(self, f, default=encode)
+        os.replace(tmp_path, self.path)
+
+    def dump(self, force=False):
+        if not self.dirty and not force:
+            return
+        if not self.journal or force or self.journal_size + len(self.dirty) > self.compact_size:
+            return self.compact()
+        with self.journal_path.open('a') as f:
+            for key in self.dirty:
+                value = self.get(key, deleted)
+                key = key if isinstance(key, str) else str(key)
+                if value is deleted:
+                    f.write(json.dumps({'k': key, 'd': 1}) + '\n')
+                else:
+                    f.write(json.dumps({'k': key, 'v': value}, default=encode) + '\n')
+                self.journal_size += 1
+        self.dirty.clear()
+
+    def compact(self):
+        self.write()
+        self.journal_path.unlink(missing_ok=True)
+        self.journal_size = 0
+        self.dirty.clear()
+
+
+class UserAppIndex:
+
+    def load(self):
+        super().load()
+        self.app_users = {}
+        for username in self:
+            self.index(username)
+
+    def index(self, username):
+        info = dict.__getitem__(self, username)
+        info['app'] = set(int(i) for i in info.get('app') or [])
+        for app_id in info['app']:
+            self.app_users.setdefault(app_id, set()).add(username)
+
+    def unindex(self, username):
+        for app_id in dict.__getitem__(self, username)['app']:
+            if users := self.app_users.get(app_id):
+                users.discard(username)
+                if not users:
+                    self.app_users.pop(app_id)
+
+    def __setitem__(self, key, value):
+        if key in self:
+            self.unindex(key)
+        super().__setitem__(key, value)
+        self.index(key)
+
+    def __delitem__(self, key):
+        if key in self:
+            self.unindex(key)
+        super().__delitem__(key)
+
+    def pop(self, key, *args):
+        if key in self:
+            self.unindex(key)
+        return super().pop(key, *args)
+
+    def clear(self):
+        self.app_users.clear()
+        super().clear()
+
+    def add_app(self, username, app_id):
+        app_id = int(app_id)
+        if app_id in self[username]['app']:
+            return False
+        self[username]['app'].add(app_id)
+        self.app_users.setdefault(app_id, set()).add(username)
+        self.touch(username)
+        return True
+
+    def has_app(self, username, app_id):
+        return int(app_id) in self[username]['app']
+
+    def get_app_users(self, app_id_list):
+        app_users = {}
+        for app_id in app_id_list:
+            for username in self.app_users.get(int(app_id), ()):
+                if self[username].get('enable'):
+                    app_users.setdefault(int(app_id), []).append(username)
+        return app_users
+
+
+class UserInfo(UserAppIndex, MyJson):
+    pass
+
+
+class StateDB:
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.migrate()
+        self.conn.executescript('''
+            create table if not exists depot (depot_id text primary key, manifest_gid text not null);
+            create table if not exists user (username text primary key, enable integer,
+                                             update_time integer not null default 0, status integer);
+            create table if not exists user_app (username text not null, app_id integer not null,
+                                                 primary key (username, app_id));
+            create index if not exists user_app_app_id on user_app (app_id);
+            create table if not exists meta (name text primary key, value text);
+        ''')
+        self.conn.commit()
+
+    def migrate(self):
+        for _, name, _, notnull, *_ in self.conn.execute('pragma table_info(user)').fetchall():
+            if name == 'enable' and notnull:
+                with self.conn:
+                    self.conn.execute('alter table user rename to user_old')
+                    self.conn.execute('create table user (username text primary key, enable integer, '
+                                      'update_time integer not null default 0, status integer)')
+                    self.conn.execute('insert into user select * from user_old')
+                    self.conn.execute('drop table user_old')
+
+    def get_meta(self, name):
+        if row := self.conn.execute('select value from meta where name = ?', (name,)).fetchone():
+            return row[0]
+
+    def set_meta(self, name, value):
+        with self.conn:
+            self.conn.execute('insert or replace into meta values (?, ?)', (name, value))
+
+    def clear(self, table):
+        with self.conn:
+            self.conn.execute(f'delete from {table}')
+            if table == 'user':
+                self.conn.execute('delete from user_app')
+
+    def count(self, table):
+        return self.conn.execute(f'select count(*) from {table}').fetchone()[0]
+
+    def get_app_users(self, app_id_list):
+        app_users = {}
+        app_id_list = list(app_id_list)
+        for i in range(0, len(app_id_list), 500):
+            chunk = app_id_list[i:i + 500]
+            for app_id, username in self.conn.execute(
+                    'select user_app.app_id, user_app.username from user_app join user using (username) '
+                    f'where user.enable and user_app.app_id in ({",".join("?" * len(chunk))})', chunk):
+                app_users.setdefault(app_id, []).append(username)
+        return app_users
+
+    def get_changed_depots(self, manifest_dict):
+        changed = set()
+        depot_id_list = list(manifest_dict)
+        for i in range(0, len(depot_id_list), 500):
+            chunk = depot_id_list[i:i + 500]
+            for depot_id, manifest_gid in self.conn.execute(
+                    f'select depot_id, manifest_gid from depot where depot_id in ({",".join("?" * len(chunk))})', chunk):
+                if manifest_dict[depot_id] != manifest_gid:
+                    changed.add(depot_id)
+        return changed
+
+
+class SqliteJson(MyJson):
+    log = logging.getLogger('SqliteJson')
+
+    def __init__(self, path, db: StateDB, table):
+        self.db = db
+        self.table = table
+        super().__init__(path)
+
+    def get_sha(self):
+        if self.path.exists():
+            return hashlib.sha1(self.path.read_bytes()).hexdigest()
+
+    def load(self):
+        sha = self.get_sha()
+        if sha and (not self.db.count(self.table) or self.db.get_meta(self.table) != sha):
+            if self.db.count(self.table):
+                self.log.warning(f'{self.path.name} changed outside the database, importing it again!')
+            self.db.clear(self.table)
+            with self.path.open() as f:
+                super(MyJson, self).update(json.load(f))
+            self.dirty.update(self)
+            self.dump()
+            self.db.set_meta(self.table, sha)
+            return
+        if self.table == 'depot':
+            for depot_id, manifest_gid in self.db.conn.execute('select depot_id, manifest_gid from depot'):
+                super(MyJson, self).__setitem__(depot_id, manifest_gid)
+        else:
+            for username, enable, update_time, status in self.db.conn.execute(
+                    'select username, enable, update_time, status from user'):
+                info = {'app': [], 'update': update_time}
+                if enable is not None:
+                    info['enable'] = bool(enable)
+                if status is not None:
+                    info['status'] = status
+                super(MyJson, self).__setitem__(username, info)
+            for username, app_id in self.db.conn.execute('select username, app_id from user_app order by rowid'):
+                self[username]['app'].append(app_id)
+        self.dirty.clear()
+
+    def dump(self, force=False):
+        if not self.dirty:
+            return
+        with self.db.conn:
+            for key in self.dirty:
+                value = self.get(key, deleted)
+                key = key if isinstance(key, str) else str(key)
+                if self.table == 'depot':
+                    if value is deleted:
+                        self.db.conn.execute('delete from depot where depot_id = ?', (key,))
+                    else:
+                        self.db.conn.execute('insert or replace into depot values (?, ?)', (key, str(value)))
+                    continue
+                self.db.conn.execute('delete from user_app where username = ?', (key,))
+                if value is deleted:
+                    self.db.conn.execute('delete from user where username = ?', (key,))
+                    continue
+                self.db.conn.execute('insert or replace into user values (?, ?, ?, ?)',
+                                     (key, int(bool(value['enable'])) if 'enable' in value else None,
+                                      value.get('update', 0), value.get('status')))
+                self.db.conn.executemany('insert or ignore into user_app values (?, ?)',
+                                         [(key, int(app_id)) for app_id in value.get('app') or []])
+        self.dirty.clear()
+
+    def write(self):
+        super().write()
+        self.db.set_meta(self.table, self.get_sha())
+
+    def compact(self):
+        self.dump()
+        self.write()
+
+
+class SqliteUserInfo(UserAppIndex, SqliteJson):
+    pass
@@ -1,38 +1,162 @@
 import os
 import vdf
+import json
+import hashlib
 import time
 import shutil
 import winreg
 import sqlite3
 import argparse
 import requests
+import tempfile
+import threading
 import traceback
 from pathlib import Path
 from multiprocessing.pool import ThreadPool
 from multiprocessing.dummy import Pool, Lock
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 lock = Lock()
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=8, pool_maxsize=64))
+mirror_pool = ThreadPoolExecutor(64)
 
 
-def get(sha, path):
-    url_list = [f'https://cdn.jsdelivr.net/gh/{repo}@{sha}/{path}',
-                f'https://ghproxy.com/https://raw.githubusercontent.com/{repo}/{sha}/{path}']
-    retry = 3
-    while True:
-        for url in url_list:
+def get_url_list(sha, path):
+    return [f'https://cdn.jsdelivr.net/gh/{repo}@{sha}/{path}',
+            f'https://ghproxy.com/https://raw.githubusercontent.com/{repo}/{sha}/{path}']
+
+
+def blob_sha1(size):
+    return hashlib.sha1(f'blob {size}\0'.encode())
+
+
+def fetch(url, save_path, blob_sha=None, size=None, stop=None, started=None, timeout=(5, 30),
+          chunk_size=64 * 1024):
+    save_path.parent.mkdir(parents=True, exist_ok=True)
+    with session.get(url, stream=True, timeout=timeout) as r:
+        r.raise_for_status()
+        if started:
+            started.set()
+        sha1 = blob_sha1(size) if blob_sha and size is not None else None
+        with tempfile.NamedTemporaryFile(dir=save_path.parent, suffix='.tmp', delete=False) as f:
             try:
-                r = requests.get(url)
-                if r.status_code == 200:
-                    return r.content
-            except requests.exceptions.ConnectionError:
-                print(f'获取失败: {path}')
-                retry -= 1
-                if not retry:
-                    print(f'超过最大重试次数: {path}')
-                    raise
+                for chunk in r.iter_content(chunk_size):
+                    if stop and stop.is_set():
+                        raise InterruptedError(url)
+                    f.write(chunk)
+                    if sha1:
+                        sha1.update(chunk)
+                if sha1 and sha1.hexdigest() != blob_sha:
+                    raise ValueError(f'sha1 mismatch: {url}')
+            except BaseException:
+                f.close()
+                os.unlink(f.name)
+                raise
+    return f.name
+
+
+def discard(future):
+    if not future.cancelled() and future.exception() is None:
+        Path(future.result()).unlink(missing_ok=True)
+
+
+def get(sha, path, save_path, blob_sha=None, size=None, retry_num=3, hedge_delay=2):
+    url_list = get_url_list(sha, path)
+    error = None
+    for retry in range(retry_num):
+        url_iter = iter(url_list)
+        started_dict = {}
+        stop = threading.Event()
+        url = next(url_iter, None)
+        while url or started_dict:
+            if url and not any(i.is_set() for i in started_dict.values()):
+                started = threading.Event()
+                started_dict[mirror_pool.submit(fetch, url, save_path, blob_sha, size, stop, started)] = started
+                url = next(url_iter, None)
+                deadline = time.monotonic() + hedge_delay
+                while url and not any(i.is_set() for i in started_dict.values()) and time.monotonic() < deadline:
+                    if wait(started_dict, timeout=0.05, return_when=FIRST_COMPLETED).done:
+                        break
+            else:
+                wait(started_dict, return_when=FIRST_COMPLETED)
+            for future in [i for i in started_dict if i.done()]:
+                started_dict.pop(future)
+                if future.exception() is None:
+                    stop.set()
+                    for i in started_dict:
+                        i.add_done_callback(discard)
+                    os.replace(future.result(), save_path)
+                    return save_path
+                error = future.exception()
+        print(f'获取失败: {path}')
+        time.sleep(retry + 1)
+    print(f'超过最大重试次数: {path}')
+    raise error
+
+
+def copy_file(src, dst):
+    with tempfile.NamedTemporaryFile(dir=dst.parent, suffix='.tmp', delete=False) as f:
+        with open(src, 'rb') as fsrc:
+            shutil.copyfileobj(fsrc, f)
+    os.replace(f.name, dst)
+
+
+class BlobCache:
+
+    def __init__(self, path, max_size=1024 * 1024 * 1024):
+        self.path = Path(path)
+        self.max_size = max_size
+        self.blob_path = self.path / 'blobs'
+        self.tree_path = self.path / 'trees'
+        self.blob_path.mkdir(parents=True, exist_ok=True)
+        self.tree_path.mkdir(parents=True, exist_ok=True)
+
+    def get_path(self, blob_sha):
+        return self.blob_path / blob_sha[:2] / blob_sha
+
+    def write(self, path, content):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=path.parent, suffix='.tmp', delete=False) as f:
+            f.write(content)
+        os.replace(f.name, path)
+
+    def get(self, blob_sha):
+        path = self.get_path(blob_sha)
+        if path.exists():
+            os.utime(path)
+            return path
 
+    def get_tree(self, sha):
+        path = self.tree_path / f'{sha}.json'
+        if path.exists():
+            os.utime(path)
+            with path.open() as f:
+                return json.load(f)
 
-def get_manifest(sha, path, steam_path: Path, app_id=None):
+    def put_tree(self, sha, tree):
+        self.write(self.tree_path / f'{sha}.json', json.dumps(tree).encode())
+
+    def evict(self):
+        file_list = [(i.stat(), i) for i in self.path.glob('*/**/*') if i.is_file()]
+        size = sum(stat.st_size for stat, _ in file_list)
+        for stat, path in sorted(file_list, key=lambda x: x[0].st_mtime):
+            if size <= self.max_size:
+                break
+            path.unlink(missing_ok=True)
+            size -= stat.st_size
+
+
+def get_blob(sha, path, blob_sha, size=None):
+    if cache_path := cache.get(blob_sha):
+        with lock:
+            print(f'使用缓存: {path}')
+        return cache_path
+    return get(sha, path, cache.get_path(blob_sha), blob_sha, size)
+
+
+def get_manifest(sha, path, steam_path: Path, app_id=None, blob_sha=None, size=None, batch=None):
     try:
         if path.endswith('.manifest'):
             depot_cache_path = steam_path / 'depotcache'
@@ -44,22 +168,15 @@ def get_manifest(sha, path, steam_path: Path, app_id=None):
                 with lock:
                     print(f'已存在清单: {path}')
                 return
-            content = get(sha, path)
+            copy_file(get_blob(sha, path, blob_sha, size), save_path)
             with lock:
                 print(f'清单下载成功: {path}')
-            with save_path.open('wb') as f:
-                f.write(content)
         elif path == 'config.vdf':
-            content = get(sha, path)
+            config_path = get_blob(sha, path, blob_sha, size)
             with lock:
                 print(f'密钥下载成功: {path}')
-            depots_config = vdf.loads(content.decode(encoding='utf-8'))
-            if depotkey_merge(steam_path / 'config' / path, depots_config):
-                print('合并config.vdf成功')
-            if stool_add(
-                    [(depot_id, '1', depots_config['depots'][depot_id]['DecryptionKey'])
-                     for depot_id in depots_config['depots']]):
-                print('导入steamtools成功')
+            with config_path.open(encoding='utf-8') as f:
+                batch.add_config(vdf.load(f))
     except KeyboardInterrupt:
         raise
     except:
@@ -81,45 +198,81 @@ def depotkey_merge(config_path, depots_config):
     if 'depots' not in steam:
         steam['depots'] = {}
     steam['depots'].update(depots_config['depots'])
-    with open(config_path, 'w', encoding='utf-8') as f:
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=config_path.parent, suffix='.tmp',
+                                     delete=False) as f:
         vdf.dump(config, f, pretty=True)
+    os.replace(f.name, config_path)
     return True
 
 
 def stool_add(depot_list):
     info_path = Path('~/AppData/Roaming/Stool/info.pak').expanduser()
     conn = sqlite3.connect(info_path)
-    c = conn.cursor()
-    for depot_id, type_, depot_key in depot_list:
-        if depot_key:
-            depot_key = f'"{depot_key}"'
-        columns = dict(filter(lambda x: x[1], zip(['appid', 'type', 'DecryptionKey'], [depot_id, type_, depot_key])))
-        sql = 'insert or replace into Appinfo ({}) values ({})'.format(','.join(columns), ','.join(columns.values()))
-        c.execute(sql)
-    conn.commit()
+    with conn:
+        conn.executemany('insert or replace into Appinfo (appid, type) values (?, ?)',
+                         [(int(depot_id), int(type_)) for depot_id, type_, depot_key in depot_list if not depot_key])
+        conn.executemany('insert or replace into Appinfo (appid, type, DecryptionKey) values (?, ?, ?)',
+                         [(int(depot_id), int(type_), depot_key) for depot_id, type_, depot_key in depot_list if
+                          depot_key])
+    conn.close()
     return True
 
 
+class ImportBatch:
+
+    def __init__(self):
+        self.depots = {}
+        self.depot_list = []
+
+    def add_app(self, app_id):
+        with lock:
+            self.depot_list.append((app_id, '1', None))
+
+    def add_config(self, depots_config):
+        with lock:
+            self.depots.update(depots_config['depots'])
+            self.depot_list.extend((depot_id, '1', depots_config['depots'][depot_id]['DecryptionKey'])
+                                   for depot_id in depots_config['depots'])
+
+    def commit(self, steam_path):
+        if self.depots and depotkey_merge(steam_path / 'config' / 'config.vdf', {'depots': self.depots}):
+            print('合并config.vdf成功')
+        if self.depot_list and stool_add(self.depot_list):
+            print('导入steamtools成功')
+        self.depots = {}
+        self.depot_list = []
+
+
 def get_steam_path():
     key = winreg.OpenKey(winreg.HKEY_CURRENT_USER, r'Software\Valve\Steam')
     steam_path = Path(winreg.QueryValueEx(key, 'SteamPath')[0])
     return steam_path
 
 
-def main(app_id):
+def main(app_id, batch=None):
+    if not batch:
+        batch = ImportBatch()
+        try:
+            return main(app_id, batch)
+        finally:
+            batch.commit(get_steam_path())
     url = f'https://api.github.com/repos/{repo}/branches/{app_id}'
-    r = requests.get(url)
+    r = session.get(url, timeout=30)
     if 'commit' in r.json():
         sha = r.json()['commit']['sha']
         url = r.json()['commit']['commit']['tree']['url']
-        r = requests.get(url)
-        if 'tree' in r.json():
-            stool_add([(app_id, '1', None)])
+        if (tree := cache.get_tree(sha)) is None:
+            r = session.get(url, timeout=30)
+            if tree := r.json().get('tree'):
+                cache.put_tree(sha, tree)
+        if tree:
+            batch.add_app(app_id)
             result_list = []
             with Pool(32) as pool:
                 pool: ThreadPool
-                for i in r.json()['tree']:
-                    result_list.append(pool.apply_async(get_manifest, (sha, i['path'], get_steam_path(), app_id)))
+                for i in tree:
+                    result_list.append(pool.apply_async(
+                        get_manifest, (sha, i['path'], get_steam_path(), app_id, i['sha'], i.get('size'), batch)))
                 try:
                     while pool._state == 'RUN':
                         if all([result.ready() for result in result_list]):
@@ -129,6 +282,7 @@ def main(app_id):
                     with lock:
                         pool.terminate()
                     raise
+            cache.evict()
             if all([result.successful() for result in result_list]):
                 print(f'入库成功: {app_id}')
                 print('重启steam生效')
@@ -137,7 +291,13 @@ def main(app_id):
     return False
 
 
-def app(app_path):
+def app(app_path, batch=None):
+    if not batch:
+        batch = ImportBatch()
+        try:
+            return app(app_path, batch)
+        finally:
+            batch.commit(get_steam_path())
     app_path = Path(app_path)
     if not app_path.is_dir():
         raise NotADirectoryError(app_path)
@@ -145,7 +305,7 @@ def app(app_path):
     app_id_list = list(filter(str.isdecimal, app_path.name.strip().split('-')))
     if app_id_list:
         app_id = app_id_list[0]
-        stool_add([(app_id, '1', None)])
+        batch.add_app(app_id)
     else:
         raise Exception('目录名称不是app_id')
     for file in app_path.iterdir():
@@ -156,30 +316,40 @@ def app(app_path):
                 print(f'导入清单成功: {file.name}')
             elif file.name == 'config.vdf':
                 with file.open('r', encoding='utf-8') as f:
-                    depots_config = vdf.loads(f.read())
-                if depotkey_merge(steam_path / 'config' / 'config.vdf', depots_config):
-                    print('合并config.vdf成功')
-                if stool_add([(depot_id, '1',
-                               depots_config['depots'][depot_id]['DecryptionKey']) for depot_id in
-                              depots_config['depots']]):
-                    print('导入steamtools成功')
+                    batch.add_config(vdf.load(f))
+
+
+def import_all(app_id_list=None, app_path_list=None):
+    batch = ImportBatch()
+    result_list = []
+    try:
+        for app_path in app_path_list or []:
+            result_list.append(app(app_path, batch) is not False)
+        for app_id in app_id_list or []:
+            result_list.append(main(app_id, batch))
+    finally:
+        batch.commit(get_steam_path())
+    return all(result_list)
 
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-r', '--repo', default='wxy1343/ManifestAutoUpdate')
-parser.add_argument('-a', '--app-id')
-parser.add_argument('-p', '--app-path')
+parser.add_argument('-a', '--app-id', dest='app_id_list', action='extend', nargs='*')
+parser.add_argument('-p', '--app-path', dest='app_path_list', action='extend', nargs='*')
+parser.add_argument('-c', '--cache-dir', default=Path('~/AppData/Local/ManifestAutoUpdate').expanduser())
+parser.add_argument('-s', '--cache-size', type=int, default=1024)
 args = parser.parse_args()
 repo = args.repo
+cache = BlobCache(args.cache_dir, args.cache_size * 1024 * 1024)
 if __name__ == '__main__':
     try:
-        if args.app_path:
-            app(args.app_path)
+        if args.app_id_list or args.app_path_list:
+            import_all(args.app_id_list, args.app_path_list)
         else:
-            main(args.app_id or input('appid: '))
+            import_all(input('appid: ').split())
     except KeyboardInterrupt:
         exit()
     except:
         traceback.print_exc()
-    if not args.app_id and not args.app_path:
+    if not args.app_id_list and not args.app_path_list:
         os.system('pause')
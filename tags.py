@@ -0,0 +1,73 @@
+import os
+import git
+import logging
+from pathlib import Path
+from multiprocessing.dummy import Lock
+
+
+class TagIndex:
+    log = logging.getLogger('TagIndex')
+
+    def __init__(self, repo: git.Repo, path=None):
+        self.repo = repo
+        self.git_dir = Path(repo.common_dir)
+        self.path = Path(path or self.git_dir / 'tag_index')
+        self.local = set()
+        self.remote = set()
+        self.dirty = False
+        self.lock = Lock()
+        self.load()
+
+    def __contains__(self, tag):
+        return tag in self.local or tag in self.remote
+
+    def __len__(self):
+        return len(self.local | self.remote)
+
+    def get_stamp(self):
+        stamp = []
+        for path in (self.git_dir / 'packed-refs', self.git_dir / 'refs' / 'tags'):
+            try:
+                stat = path.stat()
+                stamp.append(f'{stat.st_mtime_ns}:{stat.st_size}')
+            except FileNotFoundError:
+                stamp.append('-')
+        return ' '.join(stamp)
+
+    def load(self):
+        stamp = self.get_stamp()
+        if self.path.exists():
+            with self.path.open(encoding='utf-8') as f:
+                if f.readline().rstrip('\n') == stamp:
+                    self.local = set(filter(None, f.read().split('\n')))
+                    self.log.debug(f'Loaded {len(self.local)} tags from {self.path}')
+                    return
+        self.rebuild()
+
+    def rebuild(self):
+        result = self.repo.git.for_each_ref('--format=%(refname:strip=2)', 'refs/tags')
+        with self.lock:
+            self.local = set(filter(None, result.split('\n')))
+            self.dirty = True
+        self.log.debug(f'Rebuilt tag index with {len(self.local)} tags')
+
+    def add(self, tag):
+        with self.lock:
+            if tag not in self.local:
+                self.local.add(tag)
+                self.dirty = True
+
+    def update_remote(self, tags):
+        with self.lock:
+            self.remote.update(tags)
+
+    def dump(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            tmp_path = self.path.with_name(self.path.name + '.tmp')
+            with tmp_path.open('w', encoding='utf-8') as f:
+                f.write(self.get_stamp() + '\n')
+                f.write('\n'.join(sorted(self.local)))
+            os.replace(tmp_path, self.path)
+            self.dirty = False